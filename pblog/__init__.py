@@ -11,11 +11,18 @@ def setup(**kwargs):
     Pblog.instance = Pblog(**kwargs)
     cmd_map = {
             "create": "create",
+            "migrate": "migrate",
             "run": "run",
+            "render": "render",
+            "reconcile": "reconcile",
+            "reindex": "reindex",
+            "relate": "relate",
+            "build": "build",
+            "add_blog": "add_blog",
             }
 
     # Exec a command ?
     if len(sys.argv) > 1 and sys.argv[1] in cmd_map:
-        getattr(Pblog.instance, cmd_map[sys.argv[1]])()
+        getattr(Pblog.instance, cmd_map[sys.argv[1]])(*sys.argv[2:])
     else:
         Pblog.instance.run()
@@ -1,24 +1,71 @@
 # -*- coding: utf8 -*-
 
+import copy
 import random
 import hashlib
 
-from tornado.web import authenticated
-from sqlalchemy.orm import subqueryload
+from datetime import datetime
+
+from tornado.web import authenticated, HTTPError
+from sqlalchemy.orm import subqueryload, defer, undefer
 from sqlalchemy.orm.exc import NoResultFound
 
-from pblog.views import BaseHandler
+from pblog.views import BaseHandler, threaded
 from pblog.models import *
-from pblog.utils import LazyDict, slugify
-from pblog.paginator import Paginator
+from pblog.models import blog_tags
+from pblog.utils import LazyDict, slugify, PrefixIndex
+from pblog.paginator import CappedCount
+from pblog.related import update_related, remove_related
 
 __all__ = ["Login", "Admin", "PostList",
         "PostEdit", "CommentList",
         "PageList", "PageEdit", "MediaList",
-        "DesignList", "ConfEdit", "ManageLinks"]
+        "DesignList", "ConfEdit", "ManageLinks", "TagComplete"]
+
+# blog id: (blog tags version, PrefixIndex of the blog tags)
+tag_indexes = {}
+
+# suggestions returned by TagComplete
+COMPLETE_COUNT = 10
 
 class AdminHandler(BaseHandler):
 
+    def untag(self, tag):
+        """ Decrement tag counter, remove the tag if it is unused """
+        self.touch(tags=True)
+        if tag.post_count <= 1:
+            self.orm.delete(tag) # bye bye
+        else:
+            tag.post_count = Tag.post_count - 1
+
+    @property
+    def tag_index(self):
+        """ Prefix index of the blog tags and their posts count,
+            rebuilt when the tags version of the blog changes """
+        version = self.stamp.tag_version
+        cached = tag_indexes.get(self.blog_id)
+        if cached is None or cached[0] != version:
+            cached = (version,
+                    PrefixIndex(blog_tags(self.orm, self.blog_id)))
+            tag_indexes[self.blog_id] = cached
+        return cached[1]
+
+    def slug_used(self, model, slug, id=None):
+        """ Is slug used by another post/page of the blog, checked
+            without flushing the edited one (unique index) """
+        query = model.query.autoflush(False).\
+                filter(model.bid==self.blog_id).\
+                filter(model.slug==slug)
+        if id:
+            query = query.filter(model.id!=id)
+        return query.first() is not None
+
+    def discard(self, obj):
+        """ Keep the rejected changes of obj (rendered back with its
+            errors) out of the session, next queries would flush them """
+        if obj in self.orm:
+            self.orm.expunge(obj)
+
     def get_template_path(self):
         base = super(AdminHandler, self).get_template_path()
         return "%s/admin/" % (base,)
@@ -32,21 +79,24 @@ class AdminHandler(BaseHandler):
         return super(AdminHandler, self).render(*a, **kw)
 
 class Login(AdminHandler):
+    @threaded
     def get(self):
         if self.current_user == "admin":
             self.clear_cookie("user")
-            self.redirect("/")
+            return self.redirect("/")
         return self.render("login.html")
 
+    @threaded
     def post(self):
         password = self.get_argument("password", "")
         if self.conf.password != hashlib.sha1(password).hexdigest():
             return self.render("login.html")
         else:
-            self.set_secure_cookie("user", "admin")
+            self.set_secure_cookie("user", "admin:%d" % (self.blog_id,))
         self.redirect(self.get_argument("next", "/"))
 
 class Admin(AdminHandler):
+    @threaded
     @authenticated
     def get(self):
         last_comments = Comment.query.\
@@ -55,13 +105,15 @@ class Admin(AdminHandler):
         return self.render("index.html", last_comments=last_comments)
 
 class PostList(AdminHandler):
+    @threaded
     @authenticated
     def get(self):
-        page = int(self.get_argument("p", 1))
-        posts = Paginator(Post.query.\
-                filter(Post.blog==self.blog).all(),
-                self.conf.max_post).page(page)
+        posts = self.paginate(Post.query.\
+                filter(Post.blog==self.blog).\
+                options(defer(Post.excerpt), defer(Post.excerpt_html)),
+                self.conf.max_post)
         return self.render("posts.html", posts=posts)
+    @threaded
     @authenticated
     def post(self):
         for i in self.request.arguments.iterkeys():
@@ -69,7 +121,12 @@ class PostList(AdminHandler):
                     filter(Post.blog==self.blog).\
                     filter(Post.id==i).first()
             if post:
+                for t in post.tags:
+                    self.untag(t)
+                self.search_index.remove(self.orm, post.id)
+                remove_related(self.orm, post.id, post.bid)
                 self.orm.delete(post)
+        self.touch()
         self.commit()
         return self.get()
 
@@ -80,23 +137,26 @@ class PostEdit(AdminHandler):
         post_id = int(post_id)
 
         if post_id == 0:
-            return Post()
+            return Post(bid=self.blog_id)
         else:
             try:
                 post = Post.query.\
                         filter(Post.blog==self.blog).\
                         filter(Post.id==post_id).\
+                        options(undefer(Post.content)).\
                         options(subqueryload(Post.tags)).one()
                 post.errors = LazyDict()
                 return post
             except NoResultFound:
                 raise HTTPError(404)
 
+    @threaded
     @authenticated
     def get(self, post_id):
         post = self.get_post(post_id)
         return self.render("edit.html", post=post)
 
+    @threaded
     @authenticated
     def post(self, post_id):
         post = self.get_post(post_id)
@@ -112,59 +172,79 @@ class PostEdit(AdminHandler):
 
         if not post.slug:
             post.slug = slugify(post.title)
-            while Post.query.filter(Post.blog==self.blog).filter(Post.slug==post.slug).first():
+            while self.slug_used(Post, post.slug, post.id):
                 post.slug += unicode(random.randint(0, 9))
+        elif self.slug_used(Post, post.slug, post.id):
+            post.errors["slug"] = self.locale.translate("Already used")
 
         if not post.errors:
 
             tags = self.get_argument("tags", "")
 
             if tags:
-                tags = list(set([t for t in tags.split(",") if t]))
-                current_tags = [t.name for t in post.tags]
-                new_tags = [Tag.query.\
-                        filter(Tag.name==t).first() \
-                        or Tag(name=t) \
-                        for t in tags if not t in current_tags]
+                tags = set(t.strip() for t in tags.split(","))
+                tags.discard(u"")
+                current_tags = set(t.name for t in post.tags)
+                added = sorted(t for t in tags if not t in current_tags)
+                existing = {}
+                if added:
+                    existing = dict((t.name, t) for t in Tag.query.\
+                            filter(Tag.name.in_(added)))
+                new_tags = [existing.get(t) or Tag(name=t) for t in added]
 
                 for t in new_tags:
+                    self.touch(tags=True)
+                    if t.id:
+                        t.post_count = Tag.post_count + 1
+                    else:
+                        t.post_count = 1
                     post.tags.append(t)
 
                 deleted_tags = [t for t in post.tags if not t.name in tags]
                 for t in deleted_tags:
                     post.tags.remove(t)
-                    if not t.posts:
-                        self.orm.delete(t) # bye bye
+                    self.untag(t)
 
-            if not post.id:
-                self.orm.add(post)
-                self.commit()
-                self.redirect(self.application.reverse_url("PostEdit", post.id))
+            post.update_html()
+            self.touch()
 
+            created = not post.id
+            if created:
+                self.orm.add(post)
+                self.orm.flush()
+            self.search_index.update(self.orm, post)
+            update_related(self.orm, post)
             self.commit()
 
+            if created:
+                return self.redirect(self.application.reverse_url("PostEdit", post.id))
+        else:
+            self.discard(post)
         return self.render("edit.html", post=post)
 
 
 class CommentList(AdminHandler):
+    @threaded
     @authenticated
     def get(self):
-        page = int(self.get_argument("p", 1))
-        comments = Paginator(Comment.query.\
+        comments = self.paginate(Comment.query.\
                 filter(Comment.blog==self.blog).\
                 order_by(Comment.post_date.desc()).\
                 options(subqueryload(Comment.post)),
-                self.conf.max_comment).page(page)
+                self.conf.max_comment, keys=(Comment.post_date, Comment.id),
+                count=CappedCount(1000))
         return self.render("comments.html", comments=comments)
 
 class PageList(AdminHandler):
+    @threaded
     @authenticated
     def get(self):
-        page = int(self.get_argument("p", 1))
-        pages = Paginator(Page.query.\
-                filter(Page.blog==self.blog).all(),
-                self.conf.max_post).page(page)
+        pages = self.paginate(Page.query.\
+                filter(Page.blog==self.blog).\
+                options(defer(Page.content), defer(Page.html)),
+                self.conf.max_post)
         return self.render("pages.html", pages=pages)
+    @threaded
     @authenticated
     def post(self):
         for i in self.request.arguments.iterkeys():
@@ -173,6 +253,7 @@ class PageList(AdminHandler):
                     filter(Page.id==i).first()
             if page:
                 self.orm.delete(page)
+        self.touch()
         self.commit()
         return self.get()
 
@@ -183,7 +264,7 @@ class PageEdit(AdminHandler):
         page_id = int(page_id)
 
         if page_id == 0:
-            return Page()
+            return Page(bid=self.blog_id)
         else:
             try:
                 page = Page.query.\
@@ -194,11 +275,13 @@ class PageEdit(AdminHandler):
             except NoResultFound:
                 raise HTTPError(404)
 
+    @threaded
     @authenticated
     def get(self, page_id):
         page = self.get_page(page_id)
         return self.render("edit_page.html", page=page)
 
+    @threaded
     @authenticated
     def post(self, page_id):
         page = self.get_page(page_id)
@@ -212,8 +295,10 @@ class PageEdit(AdminHandler):
         if not page.slug:
             page.slug = slugify(page.title)
 
-            while Page.query.filter(Page.blog==self.blog).filter(Page.slug==page.slug).first():
+            while self.slug_used(Page, page.slug, page.id):
                 page.slug += unicode(random.randint(0, 9))
+        elif self.slug_used(Page, page.slug, page.id):
+            page.errors["slug"] = self.locale.translate("Already used")
 
         for k in ("title", "content"):
             if not getattr(page, k):
@@ -221,12 +306,17 @@ class PageEdit(AdminHandler):
 
         if not page.errors:
 
+            page.update_html()
+            self.touch()
+
             if not page.id:
                 self.orm.add(page)
                 self.commit()
-                self.redirect(self.application.reverse_url("PageEdit", page.id))
+                return self.redirect(self.application.reverse_url("PageEdit", page.id))
 
             self.commit()
+        else:
+            self.discard(page)
         return self.render("edit_page.html", page=page)
 
 class MediaList(AdminHandler):
@@ -236,27 +326,50 @@ class DesignList(AdminHandler):
     pass
 
 class ConfEdit(AdminHandler):
+    @threaded
+    @authenticated
     def get(self):
         form = self.conf.form()
         for f in form.inputs:
             if f.name != "password":
                 f.value = unicode(getattr(self.conf, f.name))
         return self.render("conf.html", form=form)
+
+    @threaded
+    @authenticated
     def post(self):
         form = self.conf.form()
         if form.validates(source=self.get_argument):
+            # the cached conf is shared, work on a copy
+            conf = copy.copy(self.conf)
             for f in form.inputs:
                 if f.name == "password" and f.value:
-                    self.conf.password = hashlib.\
+                    conf.password = hashlib.\
                             sha1(f.value).hexdigest()
                 elif f.name != "password":
-                    if isinstance(getattr(self.conf, f.name), int):
-                        setattr(self.conf, f.name, int(f.value))
+                    if isinstance(getattr(conf, f.name), int):
+                        setattr(conf, f.name, int(f.value))
                     else:
-                        setattr(self.conf, f.name, f.value)
+                        setattr(conf, f.name, f.value)
+            blog = Blog.query.get(self.blog_id)
+            blog.conf = conf
+            blog.conf_version = Blog.conf_version + 1
+            blog.modified = datetime.utcnow()
             self.commit()
+            self._conf = conf
         return self.render("conf.html", form=form)
 
 
 class ManageLinks(AdminHandler):
     pass
+
+class TagComplete(AdminHandler):
+    """ Tags of the blog starting by q (JSON), most used first """
+    @threaded
+    @authenticated
+    def get(self):
+        prefix = self.get_argument("q", u"").strip()
+        tags = self.tag_index.complete(prefix, COMPLETE_COUNT) if prefix else []
+        self.set_header("Cache-Control", "no-cache")
+        self.write({"tags": [{"name": name, "post_count": count} \
+                for name, count in tags]})
@@ -0,0 +1,250 @@
+# -*- coding: utf8 -*-
+
+""" Static pre-generation of the public blog (the "build" command)
+
+Every public route is fetched from the tornado application (served on a
+loopback port) and written under build_path:
+
+    /                       index.html, index-p2.html ...
+    /post/<slug>            post/<slug>/index.html
+    /tag/<name>             tag/<name>/index.html, index-p2.html ...
+    /archives/<y>/<m>       archives/<y>/<m>/index.html ...
+    /page/<slug>            page/<slug>/index.html
+    /feed/<type>            feed/<type>
+    /feed/tag/<name>/<type> feed/tag/<name>/<type>
+
+Listings are built by page number (?p=N). With the "keyset"
+pagination setting only their first page is built, the next ones
+(?c=) are served by the application. A nginx configuration serving
+it looks like:
+
+    location / {
+        error_page 418 = @pblog;
+        if ($arg_c) { return 418; }
+        try_files $uri/index-p$arg_p.html $uri/index.html $uri @pblog;
+    }
+    location /post/ {
+        # only the first page of comments is built, the next ones
+        # (?p=, ?c=) and /post/<slug>/comments come from the application
+        error_page 418 = @pblog;
+        if ($args) { return 418; }
+        try_files $uri/index.html @pblog;
+    }
+    location /feed/ { default_type application/xml; try_files $uri @pblog; }
+
+Each file is stored in a manifest with a signature of the rows it is
+built from, next builds only fetch files whose signature changed.
+"""
+
+import os
+import json
+import math
+import socket
+import urllib
+import urllib2
+import urlparse
+import threading
+
+from pblog.models import Blog, Post, Tag, Page, RelatedPost, table_tp, \
+        archives, blog_tags
+from pblog.utils import content_hash, RENDER_VERSION
+
+MANIFEST = ".pblog-build"
+
+
+class LocalServer(object):
+    """ Serve a tornado application on a loopback port while a
+        client function runs in a thread (handlers keep running in
+        the calling thread, with its database session) """
+
+    def __init__(self, application):
+        import tornado.ioloop
+        import tornado.httpserver
+
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.server = tornado.httpserver.HTTPServer(application,
+                io_loop=self.io_loop, xheaders=True)
+
+    def run(self, client):
+        """ Return client() result, or raise its exception """
+        result = {}
+        def target():
+            try:
+                result["value"] = client()
+            except Exception, e:
+                result["error"] = e
+            self.io_loop.add_callback(self.io_loop.stop)
+
+        self.server.listen(self.port, "127.0.0.1")
+        thread = threading.Thread(target=target)
+        thread.start()
+        try:
+            self.io_loop.start()
+        finally:
+            thread.join()
+            self.server.stop()
+        if "error" in result:
+            raise result["error"]
+        return result.get("value")
+
+
+class SiteBuilder(object):
+
+    def __init__(self, pblog, path, url):
+        self.pblog = pblog
+        self.path = os.path.abspath(path)
+        self.url = urlparse.urlparse(url)
+        self.session = pblog.session
+
+    def signature(self, *a):
+        return content_hash(repr(a))
+
+    def routes(self):
+        """ [(url, file, signature)] of every public route """
+        # the blog the application serves on the host of build_url
+        blog = self.session.query(Blog).\
+                get(self.pblog.host_blog_id(self.url.netloc))
+        conf = blog.conf
+        posts = self.session.query(Post.id, Post.title, Post.slug,
+                Post.post_date, Post.published, Post.comments_allowed,
+                Post.comment_count, Post.html_hash, Post.html_version).\
+                filter(Post.bid==blog.id).\
+                order_by(Post.post_date.desc()).all()
+        tags = {}
+        for pid, name in self.session.query(table_tp.c.pid, Tag.name).\
+                filter(Tag.id==table_tp.c.tid).\
+                filter(table_tp.c.pid==Post.id).\
+                filter(Post.bid==blog.id):
+            tags.setdefault(pid, []).append(name)
+
+        sig = dict((p.id, self.signature(tuple(p),
+            sorted(tags.get(p.id, [])))) for p in posts)
+        related = {}
+        for pid, rid in self.session.query(RelatedPost.pid, RelatedPost.rid).\
+                filter(RelatedPost.pid==Post.id).\
+                filter(Post.bid==blog.id).\
+                order_by(RelatedPost.pid, RelatedPost.rank):
+            related.setdefault(pid, []).append(rid)
+        # everything shares the sidebar, the configuration and the
+        # renderer (stored html of another RENDER_VERSION is rewritten)
+        common = self.signature(blog.conf_version, RENDER_VERSION,
+                archives(self.session, blog.id),
+                blog_tags(self.session, blog.id))
+
+        def listing(url, members):
+            members = [p for p in posts if p.id in members]
+            pages = max(1, int(math.ceil(len(members) / float(conf.max_post))))
+            if conf.pagination == "keyset":
+                # next pages are reached by cursor, from the application
+                pages = 1
+            listing_sig = self.signature(common, pages,
+                    [sig[p.id] for p in members])
+            for n in range(1, pages + 1):
+                name = "index.html" if n == 1 else "index-p%d.html" % (n,)
+                query = "" if n == 1 else "?p=%d" % (n,)
+                yield (url + query, (url.strip("/") + "/" + name).lstrip("/"),
+                        listing_sig)
+
+        def feed(url, members):
+            members = [sig[p.id] for p in posts if p.id in members]
+            feed_sig = self.signature(blog.conf_version,
+                    members[:conf.max_feed])
+            for feed_type in ("atom", "rss2"):
+                yield (url + feed_type, url.strip("/") + "/" + feed_type,
+                        feed_sig)
+
+        all_posts = set(sig)
+        for route in listing("/", all_posts):
+            yield route
+        for route in feed("/feed/", all_posts):
+            yield route
+
+        for p in posts:
+            url = "/post/%s" % (urllib.quote(p.slug.encode("utf8")),)
+            yield (url, url.strip("/") + "/index.html",
+                    self.signature(common, sig[p.id],
+                        [sig.get(r) for r in related.get(p.id, [])]))
+
+        for name in set(n for names in tags.values() for n in names):
+            members = set(pid for pid, names in tags.iteritems() \
+                    if name in names)
+            quoted = urllib.quote(name.encode("utf8"))
+            for route in listing("/tag/%s" % (quoted,), members):
+                yield route
+            for route in feed("/feed/tag/%s/" % (quoted,), members):
+                yield route
+
+        months = {}
+        for p in posts:
+            if p.post_date:
+                months.setdefault((p.post_date.year, p.post_date.month),
+                        set()).add(p.id)
+        for month, members in months.iteritems():
+            for route in listing("/archives/%d/%d" % month, members):
+                yield route
+
+        for page in self.session.query(Page.id, Page.title, Page.slug,
+                Page.html_hash, Page.html_version).\
+                        filter(Page.bid==blog.id):
+            url = "/page/%s" % (urllib.quote(page.slug.encode("utf8")),)
+            yield (url, url.strip("/") + "/index.html",
+                    self.signature(common, tuple(page)))
+
+    def target(self, name):
+        """ Absolute file path of name, which must be under self.path """
+        target = os.path.normpath(os.path.join(self.path,
+            urllib.unquote(name)))
+        if not target.startswith(self.path + os.sep):
+            raise ValueError("%r is outside of the build directory" % (name,))
+        return target
+
+    def fetch(self, server, url):
+        request = urllib2.Request("http://127.0.0.1:%d%s" % (server.port, url),
+                headers={"Host": self.url.netloc, "X-Scheme": self.url.scheme})
+        return urllib2.urlopen(request).read()
+
+    def build(self, full=False):
+        """ Write changed routes, remove the vanished ones """
+        manifest_path = os.path.join(self.path, MANIFEST)
+        manifest = {}
+        if not full and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        # render stale rows on all cores first
+        self.pblog.render(stale=True)
+
+        routes = []
+        new_manifest = {}
+        for url, name, sig in self.routes():
+            try:
+                target = self.target(name)
+            except ValueError:
+                continue
+            new_manifest[name] = sig
+            if manifest.get(name) != sig or not os.path.exists(target):
+                routes.append((url, target))
+
+        server = LocalServer(self.pblog.application)
+        def write():
+            for url, target in routes:
+                body = self.fetch(server, url)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                with open(target, "wb") as f:
+                    f.write(body)
+        server.run(write)
+
+        for name in set(manifest) - set(new_manifest):
+            target = self.target(name)
+            if os.path.exists(target):
+                os.remove(target)
+
+        with open(manifest_path, "w") as f:
+            json.dump(new_manifest, f)
+        return len(routes), len(new_manifest)
@@ -4,11 +4,14 @@
 # available from anywhere in the code.
 
 import os
+import time
+import logging
 import hashlib
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
 
-from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.exc import OperationalError, ProgrammingError, DisconnectionError, DBAPIError
+from sqlalchemy.interfaces import PoolListener
 from sqlalchemy.orm.exc import NoResultFound
 
 # This is the default config, each item can be overwrite
@@ -17,18 +20,49 @@ _defconfig = {
     "name": "Charlie blog",     # Identifier for the blog (must be unique on db)
     "host": "localhost",        # bind host (TODO any ?)
     "port": 8000,               # bind port
+    "workers": 1,               # server processes (0: one by cpu), see pblog/server.py
+    "shutdown_timeout": 10,     # seconds given to requests in progress on shutdown/restart
     "cookie_secret": os.urandom(32).encode("hex"), # used for secure cookie (must be static in production)
     "db": "sqlite:///pblog.db", # db url (as parsed by sqlalchemy : http://www.sqlalchemy.org/docs/core/engines.html)
+    "db_replicas": [],          # read-only replicas urls, public pages (GET) are read from them
+    "replica_lag": 5,           # seconds a client reads from the primary db after a write
     "debug": False,             # Turn on/off debug on tornado and sqlalchemy engine
+    "pool_size": 5,             # connections kept open by process (not for sqlite)
+    "max_overflow": 10,         # connections opened over pool_size under load (not for sqlite)
+    "pool_recycle": 3600,       # reopen connections older than this (seconds, -1 to disable)
+    "pool_pre_ping": False,     # check connections before use (server restarts, idle timeouts)
+    "db_threads": 0,            # threads running handlers database work off the IOLoop (0: on the IOLoop),
+                                # pool_size + max_overflow should be at least as large
     "template_path": "templates", # templates path (relative to cwd)
-    "static_path": "static"       # static content path (relative to cwd)
+    "static_path": "static",      # static content path (relative to cwd)
+    "build_path": "build",        # output of the "build" command (relative to cwd)
+    "build_url": "http://localhost:8000", # public url of the built site (used in feeds)
+    "cache_size": 16,           # MB of rendered pages cached by process (shared by all blogs)
     }
 
 
+class PingListener(PoolListener):
+    """ Test connections when taken from the pool, a dead
+        one is replaced by a new connection """
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        try:
+            cursor = dbapi_con.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception: # errors classes depend on the dbapi
+            raise DisconnectionError()
+
 
 class Pblog(object):
     instance = None
 
+    # seconds a failing replica is not used
+    REPLICA_RETRY = 30
+
+    # seconds between reloads of the hosts map
+    HOSTS_TTL = 60
+
     def __init__(self, **kwargs):
 
         # overwrite default config with items from kwargs
@@ -38,26 +72,88 @@ class Pblog(object):
                     val = kwargs[key]
                 setattr(self, key, val)
 
+    def create_engine(self, url):
+        kw = {"echo": self.debug, "pool_recycle": self.pool_recycle}
+        if not url.startswith("sqlite"):
+            # sqlite uses a connection by thread, not a QueuePool
+            kw["pool_size"] = self.pool_size
+            kw["max_overflow"] = self.max_overflow
+        if self.pool_pre_ping:
+            kw["listeners"] = [PingListener()]
+        return sa.create_engine(url, **kw)
+
     @property
     def engine(self):
         if not hasattr(self, "_engine"):
-            self._engine = sa.create_engine(self.db, echo=self.debug)
+            self._engine = self.create_engine(self.db)
         return self._engine
 
+    @property
+    def replicas(self):
+        if not hasattr(self, "_replicas"):
+            self._replicas = [self.create_engine(url) \
+                    for url in self.db_replicas]
+            self._replicas_down = {}
+            self._replicas_next = 0
+        return self._replicas
+
     @property
     def Session(self):
         if not hasattr(self, "_Session"):
             self._Session = orm.scoped_session(orm.sessionmaker(bind=self.engine))
         return self._Session
 
+    # Pool of threads for handlers database work (None if disabled)
+    @property
+    def db_pool(self):
+        if not hasattr(self, "_db_pool"):
+            self._db_pool = None
+            if self.db_threads:
+                from multiprocessing.pool import ThreadPool
+                self._db_pool = ThreadPool(self.db_threads)
+        return self._db_pool
+
+    # Release database connections and threads (forked processes
+    # must not share them)
+    def dispose(self):
+        self.Session.remove()
+        if hasattr(self, "_engine"):
+            self._engine.dispose()
+        for engine in getattr(self, "_replicas", []):
+            engine.dispose()
+        if hasattr(self, "_db_pool"):
+            del self._db_pool
+
+    # Session of the current thread, web requests remove it when
+    # they finish (see BaseHandler)
     @property
     def session(self):
-        if not hasattr(self, "_session"):
-            self._session = self.Session()
-        return self._session
+        return self.Session()
+
+    # New session of the current thread bound to a replica (round
+    # robin), a replica failing to connect is skipped for REPLICA_RETRY
+    # seconds. The primary is used when no replica is available
+    def read_session(self):
+        self.Session.remove()
+        replicas = self.replicas
+        for i in range(len(replicas)):
+            self._replicas_next = (self._replicas_next + 1) % len(replicas)
+            engine = replicas[self._replicas_next]
+            if self._replicas_down.get(engine, 0) > time.time():
+                continue
+            session = self.Session(bind=engine)
+            try:
+                session.connection()
+                return session
+            except DBAPIError, e:
+                logging.warning("replica %s failing: %s", engine.url, e)
+                self.Session.remove()
+                self._replicas_down[engine] = time.time() + self.REPLICA_RETRY
+        return self.session
 
     def create(self):
         from pblog.models import Blog
+        from pblog.search import create_index
 
         # Create shema ?
         try:
@@ -69,63 +165,207 @@ class Pblog(object):
 
             metadata.create_all(self.engine)
 
+        create_index(self.engine)
+
         # Create blog on database ?
         try:
             self.session.query(Blog).filter(Blog.name==self.name).one()
         except NoResultFound:
-            from pblog.models import PblogConf
-            blog = Blog(name=self.name)
-            blog.conf = PblogConf()
-            blog.conf.password = hashlib.sha1("admin").hexdigest()
-            self.session.add(blog)
-            self.session.commit()
-
-    # Return the current Blog instance
+            self.add_blog(self.name)
+
+    # Add a blog served on host (command: "add_blog <name> <host>")
+    def add_blog(self, name, host=None):
+        from pblog.models import Blog, PblogConf
+
+        if isinstance(name, str):
+            name = name.decode("utf8")
+        blog = Blog(name=name, host=host and host.lower().decode("utf8"))
+        blog.conf = PblogConf()
+        blog.conf.title = name
+        blog.conf.password = hashlib.sha1("admin").hexdigest()
+        self.session.add(blog)
+        self.session.commit()
+        if hasattr(self, "_hosts"):
+            del self._hosts
+
+    # Upgrade the schema of an existing database (new columns and
+    # indexes), then fill the new counters and stored html
+    def migrate(self):
+        from pblog.models import migrate_schema, SearchTerm, RelatedTerm, \
+                RelatedPost
+        from pblog.search import create_index, get_index, TermIndex
+
+        failed = False
+        added = set()
+        for change, error in migrate_schema(self.engine):
+            if error is None:
+                added.add(change)
+                print "added %s" % (change,)
+            else:
+                failed = True
+                print "failed to add %s: %s" % (change, error)
+        if create_index(self.engine):
+            print "added search table"
+            self.reindex()
+        elif "table %s" % (SearchTerm.__tablename__,) in added \
+                and isinstance(get_index(self.engine), TermIndex):
+            self.reindex()
+        self.reconcile()
+        self.render(stale=True)
+        if added & set("table %s" % (m.__tablename__,) \
+                for m in (RelatedTerm, RelatedPost)):
+            self.relate()
+        if failed:
+            print "fix the errors above (eg. duplicate slugs) and migrate again"
+
+    # Re-render stored html of every post, page and comment
+    # (needed after a change of markdown extensions), batches are
+    # rendered on a pool of processes. With stale=True only rows
+    # never rendered or rendered by an older RENDER_VERSION are
+    def render(self, batch=1000, workers=None, stale=False):
+        from pblog.models import Post, Page, Comment
+        from pblog.utils import markdownize_parallel, render_executor, \
+                RENDER_VERSION
+
+        # one pool of processes for all the batches
+        executor = render_executor(workers)
+        try:
+            for model in (Post, Page, Comment):
+                last_id = 0
+                while True:
+                    query = self.session.query(model).\
+                            filter(model.id > last_id)
+                    if stale:
+                        query = query.filter(sa.or_(model.html == None,
+                            model.html_version != RENDER_VERSION))
+                    if model is Post:
+                        query = query.options(orm.undefer(Post.content))
+                    items = query.order_by(model.id).limit(batch).all()
+                    if not items:
+                        break
+                    # post excerpts are rendered in the same batch
+                    excerpts = [i.split_excerpt() if model is Post \
+                            else (None, False) for i in items]
+                    html = markdownize_parallel([i.source for i in items] + \
+                            [e for e, more in excerpts if more],
+                            workers=workers, executor=executor)
+                    excerpts_html = iter(html[len(items):])
+                    for item, h, (e, more) in zip(items, html, excerpts):
+                        if model is Post:
+                            item.update_html(h,
+                                    next(excerpts_html) if more else None)
+                        else:
+                            item.update_html(h)
+                    self.session.commit()
+                    last_id = items[-1].id
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    # Rebuild the search index of all posts
+    def reindex(self):
+        from pblog.search import get_index, create_index
+
+        create_index(self.engine)
+        count = get_index(self.engine).rebuild(self.session)
+        self.session.commit()
+        print "%d posts indexed" % (count,)
+
+    # Recompute the related posts of all posts
+    def relate(self):
+        from pblog.related import rebuild_related
+
+        count = rebuild_related(self.session)
+        self.session.commit()
+        print "%d posts related" % (count,)
+
+    # Recompute post and comment counters (repair after a crash)
+    def reconcile(self):
+        from pblog.models import reconcile_counters
+
+        reconcile_counters(self.session)
+        self.session.commit()
+
+    # Pre-generate the public pages as static files
+    def build(self):
+        from pblog.build import SiteBuilder
+
+        builder = SiteBuilder(self, self.build_path, self.build_url)
+        written, total = builder.build()
+        print "%d/%d files written in %s" % (written, total, builder.path)
+
+    # Return the id of the default blog (the one named name)
     @property
-    def blog(self):
-        if not hasattr(self, "_blog"):
+    def blog_id(self):
+        if not hasattr(self, "_blog_id"):
             from pblog.models import Blog
-            self._blog = Blog.query.\
-                    filter(Blog.name==self.name).one()
-        return self._blog
+            self._blog_id = self.session.query(Blog.id).\
+                    filter(Blog.name==self.name).one().id
+        return self._blog_id
 
-    # Run the server
-    # TODO: multiprocessing
-    def run(self):
-        settings = {"login_url": "/login"}
-        for key in ("template_path", "static_path", "cookie_secret", "debug"):
-            settings[key] = getattr(self, key)
+    # Return the id of the blog served on host, the default blog (the
+    # one named name) if no blog has this host. The map is reloaded
+    # every HOSTS_TTL seconds (for blogs added by other processes)
+    def host_blog_id(self, host):
+        if getattr(self, "_hosts_expire", 0) < time.time() \
+                or not hasattr(self, "_hosts"):
+            from pblog.models import Blog
+            self._hosts = dict(self.session.query(Blog.host, Blog.id).\
+                    filter(Blog.host!=None).all())
+            self._hosts_expire = time.time() + self.HOSTS_TTL
+        return self._hosts.get(host.split(":")[0].lower(), self.blog_id)
+
+    # The tornado application serving the blog
+    @property
+    def application(self):
+        if not hasattr(self, "_application"):
+            settings = {"login_url": "/login"}
+            for key in ("template_path", "static_path", "cookie_secret", "debug"):
+                settings[key] = getattr(self, key)
+
+            import tornado.web
+            import pblog.views as views
+            import pblog.admin as admin
+
+            views.page_cache.max_size = self.cache_size * 1024 * 1024
 
-        import tornado.web
+            url = tornado.web.url
+
+            self._application = tornado.web.Application([
+                url(r"/", views.Root, name="root"),
+                url(r"/post/(.+)/comments", views.ViewComments, name="view_comments"),
+                url(r"/post/(.+)", views.View, name="view"),
+                url(r"/tag/(.+)", views.ViewTag, name="view_tag"),
+                url(r"/page/(.+)", views.ViewPage, name="view_page"),
+                url(r"/search", views.Search, name="search"),
+                url(r"/archives/(?P<year>\d+)/(?P<month>\d+)", views.ViewArchive, name="view_archive"),
+                url(r"/feed/(?P<feed_type>atom|rss2)", views.FeedPost, name="feed_posts"),
+                url(r"/feed/tag/(?P<tag_name>.*)/(?P<feed_type>atom|rss2)", views.FeedTag, name="feed_tag"),
+                url(r"/login", admin.Login, name="Login"),
+                url(r"/admin/", admin.Admin, name="Admin"),
+                url(r"/admin/posts/", admin.PostList, name="PostList"),
+                url(r"/admin/posts/edit/(\d+)", admin.PostEdit, name="PostEdit"),
+                url(r"/admin/comments/", admin.CommentList, name="CommentList"),
+                url(r"/admin/pages/", admin.PageList, name="PageList"),
+                url(r"/admin/pages/edit/(\d+)", admin.PageEdit, name="PageEdit"),
+                url(r"/admin/media/", admin.MediaList, name="MediaList"),
+                url(r"/admin/designs/", admin.DesignList, name="DesignList"),
+                url(r"/admin/conf/", admin.ConfEdit, name="ConfEdit"),
+                url(r"/admin/links/", admin.ManageLinks, name="ManageLinks"),
+                url(r"/admin/tags/complete", admin.TagComplete, name="TagComplete"),
+                ], **settings)
+        return self._application
+
+    # Run the server, in several processes if workers is not 1
+    def run(self):
+        import multiprocessing
         import tornado.httpserver
-        import tornado.ioloop
-        import pblog.views as views
-        import pblog.admin as admin
-
-        url = tornado.web.url
-
-        app = tornado.web.Application([
-            url(r"/", views.Root, name="root"),
-            url(r"/post/(.+)", views.View, name="view"),
-            url(r"/tag/(.+)", views.ViewTag, name="view_tag"),
-            url(r"/page/(.+)", views.ViewPage, name="view_page"),
-            url(r"/archives/(?P<year>\d+)/(?P<month>\d+)", views.ViewArchive, name="view_archive"),
-            url(r"/feed/(?P<feed_type>atom|rss2)", views.FeedPost, name="feed_posts"),
-            url(r"/feed/tag/(?P<tag_name>.*)/(?P<feed_type>atom|rss2)", views.FeedTag, name="feed_tag"),
-            url(r"/login", admin.Login, name="Login"),
-            url(r"/admin/", admin.Admin, name="Admin"),
-            url(r"/admin/posts/", admin.PostList, name="PostList"),
-            url(r"/admin/posts/edit/(\d+)", admin.PostEdit, name="PostEdit"),
-            url(r"/admin/comments/", admin.CommentList, name="CommentList"),
-            url(r"/admin/pages/", admin.PageList, name="PageList"),
-            url(r"/admin/pages/edit/(\d+)", admin.PageEdit, name="PageEdit"),
-            url(r"/admin/media/", admin.MediaList, name="MediaList"),
-            url(r"/admin/designs/", admin.DesignList, name="DesignList"),
-            url(r"/admin/conf/", admin.ConfEdit, name="ConfEdit"),
-            url(r"/admin/links/", admin.ManageLinks, name="ManageLinks"),
-            ], **settings)
-
-        srv = tornado.httpserver.HTTPServer(app)
+        from pblog.server import Worker, Master
+
+        srv = tornado.httpserver.HTTPServer(self.application)
         srv.bind(self.port, address=self.host)
-        srv.start()
-        tornado.ioloop.IOLoop.instance().start()
+        if self.workers == 1:
+            Worker(self, srv).run()
+        else:
+            Master(self, srv,
+                    self.workers or multiprocessing.cpu_count()).run()
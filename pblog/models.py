@@ -2,13 +2,16 @@
 
 """ SQLAlchemy models for Pblog """
 
-from datetime import datetime
+import re
+
+from datetime import datetime, date
 
 from sqlalchemy import *
 from sqlalchemy.orm import *
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import DBAPIError
 
-from pblog.utils import markdownize, LazyDict
+from pblog.utils import markdownize, content_hash, LazyDict, RENDER_VERSION
 from pblog.core import Pblog
 import pblog.forms as forms
 
@@ -20,9 +23,41 @@ Base = declarative_base()
 metadata = Base.metadata
 
 
+class Rendered(object):
+    """ Mixin storing the markdownized content at write time """
+    html = Column(UnicodeText)
+    html_hash = Column(String(40))
+    html_version = Column(Integer)
+
+    @property
+    def source(self):
+        """ Markdown source of html """
+        return self.content
+
+    def update_html(self, html=None):
+        self.html = html if html is not None else markdownize(self.source)
+        self.html_hash = content_hash(self.content)
+        self.html_version = RENDER_VERSION
+
+    @property
+    def html_stale(self):
+        return self.html is None \
+                or self.html_version != RENDER_VERSION \
+                or self.html_hash != content_hash(self.content)
+
+    # Stale html is rendered again (cached by markdownize) without
+    # touching the row, the "render" command or an edit stores it
+    @property
+    def render(self):
+        if self.html_stale:
+            return markdownize(self.source)
+        return self.html
+
+
 class Tag(Base):
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(50), nullable=False, unique=True)
+    post_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     __tablename__ = prefix + "tags"
     __mapper_args__ = {"order_by": name}
@@ -39,21 +74,38 @@ class Tag(Base):
 class Blog(Base):
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(50), nullable=False, unique=True)
-    conf = Column(PickleType)
+    # requests on this host are served by this blog
+    host = Column(Unicode(255), unique=True)
+    conf = deferred(Column(PickleType))
+    # bumped on each content/conf change, versions cached data
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    conf_version = Column(Integer, nullable=False, default=0, server_default="0")
+    # bumped when tags of the blog posts change (admin tags autocomplete)
+    tag_version = Column(Integer, nullable=False, default=0, server_default="0")
+    modified = Column(DateTime, default=datetime.utcnow)
 
     __tablename__ = prefix + "blog"
     query = Pblog.instance.Session.query_property()
 
-class Post(Base):
+class Post(Base, Rendered):
     id = Column(Integer, primary_key=True)
     title = Column(Unicode(512), nullable=False)
     post_date = Column(DateTime)
-    content = Column(UnicodeText, nullable=False)
+    # full bodies are only loaded when needed (not by lists)
+    content = deferred(Column(UnicodeText, nullable=False))
+    html = deferred(Column(UnicodeText))
+    # teaser shown in lists: content up to MORE or first paragraph
+    excerpt = Column(UnicodeText)
+    excerpt_html = Column(UnicodeText)
+    has_more = Column(Boolean)
     slug = Column(Unicode(512), nullable=False)
     published = Column(Boolean, nullable=False)
     bid = Column(Integer, ForeignKey(Blog.id), nullable=False)
     blog = relation(Blog, backref=backref("posts", order_by=post_date.desc()))
     comments_allowed = Column(Boolean, nullable=False)
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    MORE = u"<!--more-->"
 
     __tablename__ = prefix + "post"
     __mapper_args__ = {"order_by": post_date.desc()}
@@ -70,14 +122,41 @@ class Post(Base):
         kw.setdefault("post_date", datetime.now())
         kw.setdefault("published", True)
         kw.setdefault("comments_allowed", True)
-        self.bid = Pblog.instance.blog.id
+        if "bid" not in kw:
+            kw["bid"] = Pblog.instance.blog_id
 
         return super(Post, self).__init__(*a, **kw)
 
     @property
-    def render(self):
-        return markdownize(self.content)
+    def source(self):
+        return self.content.replace(self.MORE, u"")
+
+    def split_excerpt(self):
+        """ (excerpt source, has more) of the content """
+        content = self.content.strip()
+        if self.MORE in content:
+            excerpt = content.split(self.MORE, 1)[0].rstrip()
+        else:
+            excerpt = re.split(r"\n\s*\n", content, 1)[0]
+        return excerpt, excerpt != self.source.strip()
+
+    def update_html(self, html=None, excerpt_html=None):
+        super(Post, self).update_html(html)
+
+        self.excerpt, self.has_more = self.split_excerpt()
+        if not self.has_more:
+            self.excerpt_html = self.html
+        elif excerpt_html is not None:
+            self.excerpt_html = excerpt_html
+        else:
+            self.excerpt_html = markdownize(self.excerpt)
 
+    @property
+    def render_excerpt(self):
+        if self.excerpt_html is None or self.html_version != RENDER_VERSION:
+            excerpt, has_more = self.split_excerpt()
+            return markdownize(excerpt) if has_more else self.render
+        return self.excerpt_html
 
     @property
     def url_args(self):
@@ -87,7 +166,7 @@ class Post(Base):
         ret = u"<Post(%s)>" % (self.title,)
         return ret.encode("utf8")
 
-class Comment(Base):
+class Comment(Base, Rendered):
     id = Column(Integer, primary_key=True)
     post_date = Column(DateTime)
     name = Column(Unicode(512), nullable=False)
@@ -96,7 +175,8 @@ class Comment(Base):
     ip = Column(Unicode(46)) # INET6_ADDRSLEN
     pid = Column(Integer, ForeignKey(Post.id), nullable=False)
     bid = Column(Integer, ForeignKey(Blog.id), nullable=False)
-    post = relation(Post, backref=backref("comments", order_by=post_date.desc()))
+    post = relation(Post, backref=backref("comments",
+        order_by=post_date.desc(), cascade="all, delete-orphan"))
     blog = relation(Blog, backref=backref("comments", order_by=post_date.desc()))
 
     __tablename__ = prefix + "comment"
@@ -111,14 +191,11 @@ class Comment(Base):
             kw.setdefault(k, "")
 
         kw.setdefault("post_date", datetime.now())
-        self.bid = Pblog.instance.blog.id
+        if "bid" not in kw:
+            kw["bid"] = Pblog.instance.blog_id
 
         return super(Comment, self).__init__(**kw)
 
-    @property
-    def render(self):
-        return markdownize(self.content)
-
     @property
     def url_args(self):
         return ("view", self.post.slug)
@@ -127,7 +204,7 @@ class Comment(Base):
         ret = u"<Comment(%s, %s)>" % (self.name, self.ip,)
         return ret.encode("utf8")
 
-class Page(Base):
+class Page(Base, Rendered):
     id = Column(Integer, primary_key=True)
     title = Column(Unicode(512), nullable=False)
     slug = Column(Unicode(512), nullable=False)
@@ -150,17 +227,42 @@ class Page(Base):
 
         kw.setdefault("post_date", datetime.now())
         kw.setdefault("published", True)
-        self.bid = Pblog.instance.blog.id
+        if "bid" not in kw:
+            kw["bid"] = Pblog.instance.blog_id
 
         return super(Page, self).__init__(*a, **kw)
 
-    @property
-    def render(self):
-        return markdownize(self.content)
-
     def __repr__(self):
         return u"<Page (%d)>" % (self.id,)
 
+class SearchTerm(Base):
+    """ Inverted index of posts (search without full text support) """
+    term = Column(Unicode(64), primary_key=True)
+    pid = Column(Integer, ForeignKey(Post.id), primary_key=True)
+    bid = Column(Integer, ForeignKey(Blog.id), nullable=False)
+    # occurrences, weighted by field (title, tags, content)
+    weight = Column(Integer, nullable=False)
+
+    __tablename__ = prefix + "search_term"
+
+class RelatedTerm(Base):
+    """ Sparse tf-idf vector of a post (normalized, see pblog/related.py) """
+    pid = Column(Integer, ForeignKey(Post.id), primary_key=True)
+    term = Column(Unicode(64), primary_key=True)
+    bid = Column(Integer, ForeignKey(Blog.id), nullable=False)
+    weight = Column(Float, nullable=False)
+
+    __tablename__ = prefix + "related_term"
+
+class RelatedPost(Base):
+    """ Posts most similar to a post, by rank """
+    pid = Column(Integer, ForeignKey(Post.id), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    rid = Column(Integer, ForeignKey(Post.id), nullable=False)
+    score = Column(Float, nullable=False)
+
+    __tablename__ = prefix + "related"
+
 
 table_tp = Table(prefix+"tp", metadata,
         Column("pid", Integer, ForeignKey(Post.id)),
@@ -168,14 +270,105 @@ table_tp = Table(prefix+"tp", metadata,
 
 Post.tags = relation(Tag, backref="posts", secondary=table_tp)
 
-Post.comment_count = column_property(select([func.count()],
-    Comment.__table__.c.pid == Post.__table__.c.id).\
-            correlate(Post.__table__).as_scalar().label('comment_count'))
-
-Tag.post_count = column_property(select([func.count()],
-    and_(Post.__table__.c.id == table_tp.c.pid,
-        Tag.__table__.c.id == table_tp.c.tid)).\
-                correlate(Tag.__table__).as_scalar().label("post_count"))
+# archives by month (sidebar)
+Index("ix_pblog_post_archive", Post.__table__.c.bid,
+        Post.__table__.c.published, Post.__table__.c.post_date)
+# post by slug, listings (newer first, id for keyset pagination)
+Index("ix_pblog_post_slug", Post.__table__.c.bid,
+        Post.__table__.c.slug, unique=True)
+Index("ix_pblog_post_date", Post.__table__.c.bid,
+        Post.__table__.c.post_date, Post.__table__.c.id)
+Index("ix_pblog_page_slug", Page.__table__.c.bid,
+        Page.__table__.c.slug, unique=True)
+# comments of a post, last comments of a blog (admin)
+Index("ix_pblog_comment_post", Comment.__table__.c.pid,
+        Comment.__table__.c.post_date)
+Index("ix_pblog_comment_blog", Comment.__table__.c.bid,
+        Comment.__table__.c.post_date)
+# search terms of a blog
+Index("ix_pblog_search_term", SearchTerm.__table__.c.bid,
+        SearchTerm.__table__.c.term)
+# related posts: vectors sharing a term, posts listing a post
+Index("ix_pblog_related_term", RelatedTerm.__table__.c.term,
+        RelatedTerm.__table__.c.bid)
+Index("ix_pblog_related_rid", RelatedPost.__table__.c.rid)
+# tags of a post, posts of a tag
+Index("ix_pblog_tp_post", table_tp.c.pid, table_tp.c.tid, unique=True)
+Index("ix_pblog_tp_tag", table_tp.c.tid, table_tp.c.pid)
+
+# [(month date, published posts count)] of a blog, newer first
+def archives(session, bid):
+    year = extract("year", Post.post_date)
+    month = extract("month", Post.post_date)
+    archives = session.query(year, month, func.count(Post.id)).\
+            filter(Post.bid==bid).\
+            filter(Post.published==True).\
+            group_by(year, month).\
+            order_by(year.desc(), month.desc()).all()
+    return [(date(int(y), int(m), 1), n) for y, m, n in archives]
+
+# [(tag name, posts count)] of a blog (tags are shared between blogs,
+# Tag.post_count counts the posts of all blogs)
+def blog_tags(session, bid):
+    return session.query(Tag.name, func.count(table_tp.c.pid)).\
+            filter(Tag.id==table_tp.c.tid).\
+            filter(table_tp.c.pid==Post.id).\
+            filter(Post.bid==bid).\
+            group_by(Tag.name).\
+            order_by(Tag.name).all()
+
+# Recompute the denormalized counters (Tag.post_count, Post.comment_count)
+def reconcile_counters(session):
+    tags, posts = Tag.__table__, Post.__table__
+    session.execute(tags.update().values(post_count=select([func.count()],
+        table_tp.c.tid == tags.c.id).as_scalar()))
+    session.execute(posts.update().values(comment_count=select([func.count()],
+        Comment.__table__.c.pid == posts.c.id).as_scalar()))
+
+# Bring an existing database to the current schema: create missing
+# tables, add missing columns (ALTER TABLE) and missing indexes.
+# Return a list of (change, error or None)
+def migrate_schema(engine):
+    from sqlalchemy.engine.reflection import Inspector
+
+    inspector = Inspector.from_engine(engine)
+    tables = inspector.get_table_names()
+    changes = []
+
+    def apply(change, ddl):
+        try:
+            ddl()
+            changes.append((change, None))
+        except DBAPIError, e:
+            changes.append((change, e))
+
+    compiler = engine.dialect.ddl_compiler(engine.dialect, None)
+    quote = engine.dialect.identifier_preparer
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            apply("table %s" % (table.name,),
+                    lambda: table.create(engine))
+            continue
+
+        existing = set(c["name"] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            spec = compiler.get_column_specification(column)
+            if not column.nullable and column.server_default is None:
+                # rows already there have no value for it
+                spec = spec.replace(" NOT NULL", "")
+            sql = "ALTER TABLE %s ADD COLUMN %s" % \
+                    (quote.format_table(table), spec)
+            apply("column %s.%s" % (table.name, column.name),
+                    lambda: engine.execute(sql))
+
+        existing = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                apply("index %s" % (index.name,),
+                        lambda: index.create(engine))
+    return changes
 
 
 class PblogConf(object):
@@ -219,6 +412,11 @@ class PblogConf(object):
                 class_="small-form-input",
                 description="Max comments by feed",
                 ),
+            forms.Dropdown("pagination",
+                [("pages", "Page numbers"), ("keyset", "Previous / Next")],
+                description="Pagination",
+                pre="Previous / Next stays fast on large blogs",
+                ),
             forms.Dropdown("email",
                 [(unicode(EMAIL_DISABLED), "Disabled"), (unicode(EMAIL_OPTIONAL), "Optional"), (unicode(EMAIL_REQUIRED), "Required")],
                 description="Email",
@@ -237,6 +435,12 @@ class PblogConf(object):
         self.title = Pblog.instance.name
         self.email = self.EMAIL_OPTIONAL
         self.password = ""
+        self.pagination = "pages"
+
+    def __setstate__(self, state):
+        # confs pickled by an older version miss the new options
+        self.__init__()
+        self.__dict__.update(state)
 
     def __eq__(self, other):
         return self.__dict__ == other.__dict__ if other else False
@@ -2,7 +2,10 @@
 
 """ Paginate objects. Taken from django project and add sqlalchemy support """
 
+import base64
 from math import ceil
+from datetime import datetime
+from sqlalchemy import and_, or_
 from sqlalchemy.orm.query import Query
 
 class InvalidPage(Exception):
@@ -14,13 +17,87 @@ class PageNotAnInteger(InvalidPage):
 class EmptyPage(InvalidPage):
     pass
 
+class InvalidCursor(InvalidPage):
+    pass
+
+class ExactCount(object):
+    """ Count strategy: count() of the whole object list (default) """
+
+    def __call__(self, object_list):
+        try:
+            return object_list.count()
+        except (AttributeError, TypeError):
+            # AttributeError if object_list has no count() method.
+            # TypeError if object_list.count() requires arguments
+            # (i.e. is of type list).
+            return len(object_list)
+
+    def exact(self, count):
+        return True
+
+class CachedCount(ExactCount):
+    """ Count strategy: exact count stored in cache (a LRUCache) under
+        key, which must change with the content (eg. a blog version) """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def __call__(self, object_list):
+        count = self.cache.get(self.key)
+        if count is None:
+            count = super(CachedCount, self).__call__(object_list)
+            self.cache.set(self.key, count, size=64)
+        return count
+
+class KnownCount(ExactCount):
+    """ Count strategy: a total known beforehand (eg. a counter
+        column), no query """
+
+    def __init__(self, count):
+        self.count = count
+
+    def __call__(self, object_list):
+        return self.count
+
+class CappedCount(ExactCount):
+    """ Count strategy: count at most cap + 1 objects, the total is
+        then displayed as "cap+" """
+
+    def __init__(self, cap=1000):
+        self.cap = cap
+
+    def __call__(self, object_list):
+        if isinstance(object_list, Query):
+            return object_list.limit(self.cap + 1).count()
+        return min(len(object_list), self.cap + 1)
+
+    def exact(self, count):
+        return count <= self.cap
+
+class NoCount(object):
+    """ Count strategy: no total, only tell if there is a next page """
+
+    def __call__(self, object_list):
+        return None
+
+    def exact(self, count):
+        return False
+
 class Paginator(object):
-    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True):
+    param = "p" # request argument holding the page number
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+            count=None):
         self.object_list = object_list
         self.per_page = per_page
         self.orphans = orphans
         self.allow_empty_first_page = allow_empty_first_page
+        self.count_strategy = count or ExactCount()
         self._num_pages = self._count = None
+        self._counted = False
+        # (page number, has a next page) when the total is not exact
+        self._last_page = (1, True)
 
     def validate_number(self, number):
         "Validates the given 1-based page number."
@@ -30,7 +107,7 @@ class Paginator(object):
             raise PageNotAnInteger('That page number is not an integer')
         if number < 1:
             raise EmptyPage('That page number is less than 1')
-        if number > self.num_pages:
+        if self.count_exact and number > self.num_pages:
             if number == 1 and self.allow_empty_first_page:
                 pass
             else:
@@ -41,6 +118,18 @@ class Paginator(object):
         "Returns a Page object for the given 1-based page number."
         number = self.validate_number(number)
         bottom = (number - 1) * self.per_page
+
+        if not self.count_exact:
+            # unknown total, one more object tells if there is a next page
+            if isinstance(self.object_list, Query):
+                data = self.object_list.offset(bottom).limit(self.per_page + 1).all()
+            else:
+                data = self.object_list[bottom:bottom + self.per_page + 1]
+            if not data and number > 1:
+                raise EmptyPage('That page contains no results')
+            self._last_page = (number, len(data) > self.per_page)
+            return Page(data[:self.per_page], number, self)
+
         top = bottom + self.per_page
         if top + self.orphans >= self.count:
             top = self.count
@@ -54,20 +143,34 @@ class Paginator(object):
         return Page(data, number, self)
 
     def _get_count(self):
-        "Returns the total number of objects, across all pages."
-        if self._count is None:
-            try:
-                self._count = self.object_list.count()
-            except (AttributeError, TypeError):
-                # AttributeError if object_list has no count() method.
-                # TypeError if object_list.count() requires arguments
-                # (i.e. is of type list).
-                self._count = len(self.object_list)
+        "Returns the total number of objects, across all pages (may be None)."
+        if not self._counted:
+            self._count = self.count_strategy(self.object_list)
+            self._counted = True
         return self._count
     count = property(_get_count)
 
+    def _get_count_exact(self):
+        "Is count the exact total ?"
+        return self.count_strategy.exact(self.count)
+    count_exact = property(_get_count_exact)
+
+    def _get_count_display(self):
+        "Total for display: 42, 1000+ or an empty string if unknown."
+        if self.count_exact:
+            return unicode(self.count)
+        elif self.count is not None:
+            return u"%d+" % (self.count - 1,)
+        return u""
+    count_display = property(_get_count_display)
+
     def _get_num_pages(self):
-        "Returns the total number of pages."
+        "Returns the total number of pages (known so far if count is not exact)."
+        if not self.count_exact:
+            number, more = self._last_page
+            hits = max(1, self.count or 0)
+            known = int(ceil(hits / float(self.per_page)))
+            return max(known, number + int(more))
         if self._num_pages is None:
             if self.count == 0 and not self.allow_empty_first_page:
                 self._num_pages = 0
@@ -130,3 +233,104 @@ class Page(object):
         if self.number == self.paginator.num_pages:
             return self.paginator.count
         return self.number * self.paginator.per_page
+
+
+class KeysetPaginator(object):
+    """ Paginate a sqlalchemy query in descending order of keys (unique
+        together, eg. (Post.post_date, Post.id)) with opaque cursors, so
+        every page costs the same: no OFFSET and no COUNT """
+    param = "c" # request argument holding the cursor
+    page_range = []
+
+    def __init__(self, object_list, per_page, keys):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.keys = keys
+
+    def encode_cursor(self, direction, obj):
+        values = [direction]
+        for key in self.keys:
+            value = getattr(obj, key.key)
+            if isinstance(value, datetime):
+                values.append("d" + value.strftime("%Y%m%d%H%M%S%f"))
+            else:
+                values.append("i%d" % (value,))
+        return base64.urlsafe_b64encode("|".join(values))
+
+    def decode_cursor(self, cursor):
+        try:
+            values = base64.urlsafe_b64decode(str(cursor)).split("|")
+            direction, values = values[0], values[1:]
+            if direction not in ("n", "p") or len(values) != len(self.keys):
+                raise ValueError
+            return direction, [datetime.strptime(v[1:], "%Y%m%d%H%M%S%f") \
+                    if v[0] == "d" else int(v[1:]) for v in values]
+        except (TypeError, ValueError):
+            raise InvalidCursor("Invalid cursor")
+
+    def _after(self, values, before=False):
+        """ Rows strictly after (or before) values in keys order """
+        clause = None
+        for key, value in reversed(zip(self.keys, values)):
+            cmp = key > value if before else key < value
+            if clause is None:
+                clause = cmp
+            else:
+                clause = or_(cmp, and_(key == value, clause))
+        return clause
+
+    def page(self, cursor=None):
+        "Returns a KeysetPage, for the first page if cursor is None."
+        query = self.object_list
+        direction = "n"
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+            query = query.filter(self._after(values, direction == "p"))
+
+        query = query.order_by(None)
+        if direction == "n":
+            query = query.order_by(*[k.desc() for k in self.keys])
+        else:
+            query = query.order_by(*[k.asc() for k in self.keys])
+
+        # one more row tells if there is a page after this one
+        data = query.limit(self.per_page + 1).all()
+        more = len(data) > self.per_page
+        data = data[:self.per_page]
+
+        if direction == "n":
+            return KeysetPage(data, self, bool(cursor), more)
+        if not more:
+            # back to the start, show a full first page
+            return self.page()
+        data.reverse()
+        return KeysetPage(data, self, True, True)
+
+class KeysetPage(object):
+    number = None
+
+    def __init__(self, object_list, paginator, previous, next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._previous = previous and bool(object_list)
+        self._next = next and bool(object_list)
+
+    def __repr__(self):
+        return '<KeysetPage of %d items>' % (len(self.object_list),)
+
+    def has_next(self):
+        return self._next
+
+    def has_previous(self):
+        return self._previous
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        "Cursor of the next page."
+        return self.paginator.encode_cursor("n", self.object_list[-1])
+
+    def previous_page_number(self):
+        "Cursor of the previous page."
+        return self.paginator.encode_cursor("p", self.object_list[0])
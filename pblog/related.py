@@ -0,0 +1,197 @@
+# -*- coding: utf8 -*-
+
+""" Related posts, by cosine similarity of tf-idf vectors
+
+Each published post has a sparse vector (RelatedTerm rows: its
+MAX_TERMS best terms of content and tags, normalized) and its
+RELATED_COUNT most similar posts of the same blog (RelatedPost rows).
+
+The "relate" command computes everything. Saving a post updates its
+vector and the lists of the posts it enters or leaves, using document
+frequencies of the stored vectors (until the next "relate").
+"""
+
+import math
+import heapq
+
+from sqlalchemy import func
+from sqlalchemy.orm import aliased, subqueryload, undefer
+
+from pblog.models import Post, Blog, RelatedTerm, RelatedPost
+from pblog.search import tokenize
+
+RELATED_COUNT = 5
+MAX_TERMS = 50
+# a tag counts as this many occurrences of a word
+TAG_WEIGHT = 3
+
+# sqlite limits the number of parameters of a query
+CHUNK = 500
+
+
+def features(post):
+    """ {term: occurrences} of post content and tags """
+    counts = {}
+    for term in tokenize(post.source):
+        term = term[:64]
+        counts[term] = counts.get(term, 0) + 1
+    for tag in post.tags:
+        term = (u"#" + tag.name.lower())[:64]
+        counts[term] = counts.get(term, 0) + TAG_WEIGHT
+    return counts
+
+def vector(counts, df, total):
+    """ Normalized tf-idf {term: weight}, df: {term: documents count} """
+    weights = dict((t, (1 + math.log(c)) * \
+            (1 + math.log((1.0 + total) / (1 + df.get(t, 0))))) \
+            for t, c in counts.iteritems())
+    weights = dict(heapq.nlargest(MAX_TERMS, weights.iteritems(),
+        key=lambda i: (i[1], i[0])))
+    norm = math.sqrt(sum(w * w for w in weights.itervalues())) or 1.0
+    return dict((t, w / norm) for t, w in weights.iteritems())
+
+def chunks(items):
+    items = list(items)
+    for i in range(0, len(items), CHUNK):
+        yield items[i:i+CHUNK]
+
+
+def related_posts(session, post):
+    """ Published posts related to post, most similar first """
+    return session.query(Post).\
+            join((RelatedPost, RelatedPost.rid==Post.id)).\
+            filter(RelatedPost.pid==post.id).\
+            filter(Post.published==True).\
+            order_by(RelatedPost.rank).all()
+
+def neighbours(session, pid, bid, limit=None):
+    """ [(post id, similarity)] of the posts sharing terms with pid """
+    a, b = aliased(RelatedTerm), aliased(RelatedTerm)
+    score = func.sum(a.weight * b.weight)
+    query = session.query(b.pid, score).\
+            filter(a.pid==pid).\
+            filter(b.term==a.term).\
+            filter(b.bid==bid).\
+            filter(b.pid!=pid).\
+            group_by(b.pid).\
+            order_by(score.desc(), b.pid.desc())
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+def store(session, pid, related):
+    session.execute(RelatedPost.__table__.delete().\
+            where(RelatedPost.pid==pid))
+    if related:
+        session.execute(RelatedPost.__table__.insert(),
+                [{"pid": pid, "rank": rank, "rid": rid, "score": score} \
+                        for rank, (rid, score) in enumerate(related)])
+
+def store_vector(session, pid, bid, weights):
+    if weights:
+        session.execute(RelatedTerm.__table__.insert(),
+                [{"pid": pid, "bid": bid, "term": t, "weight": w} \
+                        for t, w in weights.iteritems()])
+
+def _remove(session, pid):
+    """ Remove the vector and list of pid, return the posts listing it """
+    listing = set(r[0] for r in session.query(RelatedPost.pid).\
+            filter(RelatedPost.rid==pid))
+    session.execute(RelatedTerm.__table__.delete().\
+            where(RelatedTerm.pid==pid))
+    session.execute(RelatedPost.__table__.delete().\
+            where(RelatedPost.pid==pid))
+    listing.discard(pid)
+    return listing
+
+def update_related(session, post):
+    """ Recompute the vector and related posts of post, and the lists
+        of the posts it enters or leaves """
+    affected = _remove(session, post.id)
+
+    if post.published:
+        counts = features(post)
+        df = {}
+        for terms in chunks(counts):
+            df.update(session.query(RelatedTerm.term,
+                func.count(RelatedTerm.pid)).\
+                        filter(RelatedTerm.bid==post.bid).\
+                        filter(RelatedTerm.term.in_(terms)).\
+                        group_by(RelatedTerm.term).all())
+        total = session.query(func.count(func.distinct(RelatedTerm.pid))).\
+                filter(RelatedTerm.bid==post.bid).scalar()
+        df = dict((t, df.get(t, 0) + 1) for t in counts)
+        store_vector(session, post.id, post.bid,
+                vector(counts, df, total + 1))
+
+        scores = neighbours(session, post.id, post.bid)
+        store(session, post.id, scores[:RELATED_COUNT])
+
+        # posts whose list post enters: short list or worse last one
+        lists = {}
+        for pids in chunks(pid for pid, score in scores):
+            for pid, worst, count in session.query(RelatedPost.pid,
+                    func.min(RelatedPost.score), func.count(RelatedPost.rank)).\
+                            filter(RelatedPost.pid.in_(pids)).\
+                            group_by(RelatedPost.pid):
+                lists[pid] = (worst, count)
+        for pid, score in scores:
+            worst, count = lists.get(pid, (0, 0))
+            if count < RELATED_COUNT or score > worst:
+                affected.add(pid)
+
+    for pid in affected:
+        store(session, pid, neighbours(session, pid, post.bid, RELATED_COUNT))
+
+def remove_related(session, pid, bid):
+    """ Remove post pid (before deleting it) from related posts """
+    for other in _remove(session, pid):
+        store(session, other, neighbours(session, other, bid, RELATED_COUNT))
+
+def rebuild_related(session, batch=1000):
+    """ Compute vectors and related posts of every published post,
+        return their count """
+    session.execute(RelatedPost.__table__.delete())
+    session.execute(RelatedTerm.__table__.delete())
+    done = 0
+    for (bid,) in session.query(Blog.id):
+        counts = {}
+        last_id = 0
+        while True:
+            posts = session.query(Post).\
+                    filter(Post.bid==bid).\
+                    filter(Post.published==True).\
+                    filter(Post.id > last_id).\
+                    options(undefer(Post.content)).\
+                    options(subqueryload(Post.tags)).\
+                    order_by(Post.id).limit(batch).all()
+            if not posts:
+                break
+            for post in posts:
+                counts[post.id] = features(post)
+            last_id = posts[-1].id
+            session.expunge_all()
+
+        df = {}
+        for c in counts.itervalues():
+            for term in c:
+                df[term] = df.get(term, 0) + 1
+        vectors = dict((pid, vector(c, df, len(counts))) \
+                for pid, c in counts.iteritems())
+
+        postings = {}
+        for pid, weights in vectors.iteritems():
+            store_vector(session, pid, bid, weights)
+            for term, weight in weights.iteritems():
+                postings.setdefault(term, []).append((pid, weight))
+
+        for pid, weights in vectors.iteritems():
+            scores = {}
+            for term, weight in weights.iteritems():
+                for other, w in postings[term]:
+                    if other != pid:
+                        scores[other] = scores.get(other, 0) + weight * w
+            store(session, pid, heapq.nlargest(RELATED_COUNT,
+                scores.iteritems(), key=lambda i: (i[1], i[0])))
+        done += len(vectors)
+    return done
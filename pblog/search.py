@@ -0,0 +1,229 @@
+# -*- coding: utf8 -*-
+
+""" Full text search of posts (titles, content and tags)
+
+Published posts are indexed when they are saved, in the transaction
+saving them, by the index of the database:
+
+    - FTS5Index: a sqlite FTS5 virtual table, ranked by bm25
+    - TermIndex: an inverted index (SearchTerm table) ranked by
+      tf-idf, for other databases or sqlite without FTS5
+
+The FTS5 table is created by the "create", "migrate" and "reindex"
+commands, the index is chosen once by process from the tables of the
+database (restart the servers after adding the table). The "reindex"
+command rebuilds the index of every post.
+"""
+
+import re
+import math
+import unicodedata
+
+from sqlalchemy import case, func, literal, Float
+from sqlalchemy.orm import subqueryload, undefer
+
+from pblog.models import Post, SearchTerm
+
+# weight of a word by field
+WEIGHTS = {"title": 10, "tags": 5, "content": 1}
+
+_indexes = {}
+
+
+def tokenize(text):
+    """ Lower case words of text, without accents """
+    text = unicodedata.normalize("NFKD", text)
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+    return [w for w in re.findall(r"\w+", text.lower(), re.UNICODE) \
+            if len(w) > 1]
+
+def has_fts5(engine):
+    """ Is the fts5 module available, tested on a throwaway in-memory
+        database of the engine dbapi """
+    con = engine.dialect.dbapi.connect(":memory:")
+    try:
+        con.execute("CREATE VIRTUAL TABLE t USING fts5(c)")
+        return True
+    except engine.dialect.dbapi.OperationalError:
+        return False
+    finally:
+        con.close()
+
+def fts5_table_exists(engine):
+    return bool(engine.execute("SELECT count(*) FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'pblog_search'").scalar())
+
+def create_index(engine):
+    """ Create the FTS5 table if the database supports it (from the
+        commands, never in a request), return True if it was created """
+    if engine.dialect.name != "sqlite" or not has_fts5(engine):
+        return False
+    created = not fts5_table_exists(engine)
+    engine.execute(FTS5Index.CREATE)
+    _indexes.pop(engine, None)
+    return created
+
+def get_index(engine):
+    """ The search index of the database engine: FTS5Index if its table
+        exists (see create_index), TermIndex otherwise """
+    if engine not in _indexes:
+        index = TermIndex()
+        if engine.dialect.name == "sqlite" and fts5_table_exists(engine):
+            index = FTS5Index()
+        _indexes[engine] = index
+    return _indexes[engine]
+
+class SearchIndex(object):
+
+    def fields(self, post):
+        return {"title": post.title, "content": post.source,
+                "tags": u" ".join(t.name for t in post.tags)}
+
+    def update(self, session, post):
+        """ Index post (remove it if it is not published) """
+        self.remove(session, post.id)
+        if post.published:
+            self.add(session, post)
+
+    def rebuild(self, session, batch=1000):
+        """ Index all published posts, return their count """
+        self.clear(session)
+        last_id = count = 0
+        while True:
+            posts = session.query(Post).\
+                    filter(Post.id > last_id).\
+                    filter(Post.published==True).\
+                    options(undefer(Post.content)).\
+                    options(subqueryload(Post.tags)).\
+                    order_by(Post.id).limit(batch).all()
+            if not posts:
+                break
+            for post in posts:
+                self.add(session, post)
+            last_id = posts[-1].id
+            count += len(posts)
+        return count
+
+    def results(self, session, bid, query):
+        """ Ranked posts matching query, as a list for Paginator """
+        return SearchResults(self, session, bid, tokenize(query))
+
+
+class FTS5Index(SearchIndex):
+
+    CREATE = "CREATE VIRTUAL TABLE IF NOT EXISTS pblog_search " \
+            "USING fts5(title, content, tags, bid UNINDEXED)"
+    MATCH = "FROM pblog_search WHERE pblog_search MATCH :q AND bid = :bid"
+
+    def add(self, session, post):
+        params = self.fields(post)
+        params.update(pid=post.id, bid=post.bid)
+        session.execute("INSERT INTO pblog_search(rowid, title, content, "
+                "tags, bid) VALUES (:pid, :title, :content, :tags, :bid)",
+                params)
+
+    def remove(self, session, pid):
+        session.execute("DELETE FROM pblog_search WHERE rowid = :pid",
+                {"pid": pid})
+
+    def clear(self, session):
+        session.execute("DELETE FROM pblog_search")
+
+    def match(self, terms):
+        # quoted terms, all required
+        return u" ".join(u'"%s"' % (t,) for t in terms)
+
+    def count(self, session, bid, terms):
+        return session.execute("SELECT count(*) " + self.MATCH,
+                {"q": self.match(terms), "bid": bid}).scalar()
+
+    def search(self, session, bid, terms, offset, limit):
+        weights = (WEIGHTS["title"], WEIGHTS["content"], WEIGHTS["tags"])
+        return [r[0] for r in session.execute("SELECT rowid " + self.MATCH +
+                " ORDER BY bm25(pblog_search, %d, %d, %d), rowid DESC"
+                " LIMIT :limit OFFSET :offset" % weights,
+                {"q": self.match(terms), "bid": bid,
+                    "limit": limit, "offset": offset})]
+
+
+class TermIndex(SearchIndex):
+
+    def add(self, session, post):
+        weights = {}
+        for field, text in self.fields(post).iteritems():
+            for term in tokenize(text):
+                term = term[:64]
+                weights[term] = weights.get(term, 0) + WEIGHTS[field]
+        table = SearchTerm.__table__
+        if weights:
+            session.execute(table.insert(), [{"term": t, "pid": post.id,
+                "bid": post.bid, "weight": w} for t, w in weights.iteritems()])
+
+    def remove(self, session, pid):
+        session.execute(SearchTerm.__table__.delete().\
+                where(SearchTerm.pid==pid))
+
+    def clear(self, session):
+        session.execute(SearchTerm.__table__.delete())
+
+    def matching(self, session, bid, terms):
+        """ Query of (pid, score) of posts having all terms """
+        terms = list(set(t[:64] for t in terms))
+        df = dict(session.query(SearchTerm.term, func.count(SearchTerm.pid)).\
+                filter(SearchTerm.bid==bid).\
+                filter(SearchTerm.term.in_(terms)).\
+                group_by(SearchTerm.term).all())
+        if not terms or len(df) < len(terms):
+            return None
+        total = session.query(func.count(func.distinct(SearchTerm.pid))).\
+                filter(SearchTerm.bid==bid).scalar()
+        score = func.sum(case([(SearchTerm.term==t, SearchTerm.weight * \
+                literal(math.log(1.0 + float(total) / df[t]))) \
+                    for t in terms]), type_=Float)
+        return session.query(SearchTerm.pid, score.label("score")).\
+                filter(SearchTerm.bid==bid).\
+                filter(SearchTerm.term.in_(terms)).\
+                group_by(SearchTerm.pid).\
+                having(func.count(SearchTerm.term)==len(terms))
+
+    def count(self, session, bid, terms):
+        query = self.matching(session, bid, terms)
+        return query.count() if query is not None else 0
+
+    def search(self, session, bid, terms, offset, limit):
+        query = self.matching(session, bid, terms)
+        if query is None:
+            return []
+        return [r[0] for r in query.\
+                order_by("score DESC", SearchTerm.pid.desc()).\
+                offset(offset).limit(limit)]
+
+
+class SearchResults(object):
+    """ Posts matching terms, fetched by slices (Paginator pages) """
+
+    def __init__(self, index, session, bid, terms):
+        self.index = index
+        self.session = session
+        self.bid = bid
+        self.terms = terms
+
+    def count(self):
+        if not self.terms:
+            return 0
+        return self.index.count(self.session, self.bid, self.terms)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, s):
+        if not self.terms:
+            return []
+        ids = self.index.search(self.session, self.bid, self.terms,
+                s.start, s.stop - s.start)
+        if not ids:
+            return []
+        posts = dict((p.id, p) for p in self.session.query(Post).\
+                filter(Post.id.in_(ids)).\
+                options(subqueryload(Post.tags)))
+        return [posts[i] for i in ids if i in posts]
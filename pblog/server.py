@@ -0,0 +1,254 @@
+# -*- coding: utf8 -*-
+
+""" Serving in one or several processes (the "workers" setting)
+
+With more than one worker, the master process binds the listening
+socket and forks the workers, each one running its own IOLoop on the
+shared socket. The master:
+
+    - restarts workers which died or stopped sending heartbeats
+    - SIGTERM, SIGINT: graceful shutdown, workers stop accepting
+      connections and finish their requests (up to shutdown_timeout)
+    - SIGHUP: graceful restart, new workers are started and the old
+      ones shut down gracefully
+    - SIGUSR1: logs the health of every worker
+
+Workers report their health (requests served and in progress, page
+cache stats) to the master every HEARTBEAT seconds on a pipe.
+"""
+
+import os
+import time
+import json
+import errno
+import signal
+import select
+import logging
+
+HEARTBEAT = 5 # seconds
+
+log = logging.getLogger("pblog.server")
+
+
+class Worker(object):
+    """ Serve the application in this process until SIGTERM """
+
+    def __init__(self, pblog, server, pipe=None):
+        self.pblog = pblog
+        self.server = server
+        self.pipe = pipe
+
+    def run(self):
+        import tornado.ioloop
+
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.server.start()
+        signal.signal(signal.SIGTERM,
+                lambda *a: self.io_loop.add_callback(self.stop))
+        if self.pipe is not None:
+            # the master handles these ones
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            self.heartbeat()
+            tornado.ioloop.PeriodicCallback(self.heartbeat,
+                    HEARTBEAT * 1000, io_loop=self.io_loop).start()
+        self.io_loop.start()
+
+    def health(self):
+        from pblog.views import active_handlers, request_stats, page_cache
+        return {"pid": os.getpid(),
+                "requests": request_stats["finished"],
+                "active": len(active_handlers),
+                "page_cache": page_cache.stats}
+
+    def heartbeat(self):
+        try:
+            os.write(self.pipe, json.dumps(self.health()) + "\n")
+        except OSError:
+            # master is gone
+            self.stop()
+
+    def stop(self):
+        """ Stop accepting connections, then stop the IOLoop when
+            requests in progress are finished (or shutdown_timeout) """
+        from pblog.views import active_handlers
+
+        if getattr(self, "_stopping", False):
+            return
+        self._stopping = True
+        self.server.stop()
+        deadline = time.time() + self.pblog.shutdown_timeout
+        def check():
+            if not active_handlers or time.time() > deadline:
+                self.io_loop.stop()
+            else:
+                self.io_loop.add_timeout(time.time() + 0.1, check)
+        check()
+
+
+class WorkerProcess(object):
+    """ State of a worker, as seen by the master """
+
+    def __init__(self, pid, index, pipe):
+        self.pid = pid
+        self.index = index
+        self.pipe = pipe
+        self.started = self.seen = time.time()
+        self.health = {}
+        self.retiring = False
+        self._buffer = ""
+
+    def read(self):
+        """ Read heartbeats available on the pipe """
+        data = os.read(self.pipe, 65536)
+        if not data:
+            return
+        self._buffer += data
+        lines = self._buffer.split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            try:
+                self.health = json.loads(line)
+                self.seen = time.time()
+            except ValueError:
+                log.error("worker %d: bad heartbeat %r", self.index, line)
+
+    def report(self):
+        cache = self.health.get("page_cache", {})
+        lookups = cache.get("hits", 0) + cache.get("misses", 0)
+        return "worker %d (pid %d): up %ds, last seen %ds ago, " \
+                "%d requests, %d in progress, page cache %d%% hits" % \
+                (self.index, self.pid, time.time() - self.started,
+                        time.time() - self.seen,
+                        self.health.get("requests", 0),
+                        self.health.get("active", 0),
+                        100 * cache.get("hits", 0) / (lookups or 1))
+
+
+class Master(object):
+    """ Fork and supervise workers processes """
+
+    def __init__(self, pblog, server, workers):
+        self.pblog = pblog
+        self.server = server
+        self.size = workers
+        self.workers = {}
+        self.signals = []
+
+    def spawn(self, index):
+        # no database connection must be shared with the child
+        self.pblog.dispose()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            for worker in self.workers.values():
+                os.close(worker.pipe)
+            code = 0
+            try:
+                self.pblog.dispose()
+                Worker(self.pblog, self.server, write).run()
+            except:
+                log.exception("worker %d failed", index)
+                code = 1
+            os._exit(code)
+        os.close(write)
+        self.workers[pid] = WorkerProcess(pid, index, read)
+        log.info("worker %d started (pid %d)", index, pid)
+
+    def kill(self, worker, sig=signal.SIGTERM):
+        try:
+            os.kill(worker.pid, sig)
+        except OSError:
+            pass
+
+    def reap(self):
+        """ Handle finished workers, restart them if needed """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.pipe)
+            if worker.retiring or self.stopping:
+                log.info("worker %d (pid %d) stopped", worker.index, pid)
+                continue
+            log.warning("worker %d (pid %d) exited with status %d, restarting",
+                    worker.index, pid, status)
+            if time.time() - worker.started < 1:
+                time.sleep(1) # do not fork in a loop
+            self.spawn(worker.index)
+
+    def check(self):
+        """ Kill workers not sending heartbeats (stuck IOLoop) """
+        for worker in self.workers.values():
+            if not worker.retiring and \
+                    time.time() - worker.seen > 3 * HEARTBEAT:
+                log.error("%s, killing it", worker.report())
+                self.kill(worker, signal.SIGKILL)
+                worker.seen = time.time()
+
+    def restart(self):
+        log.info("restarting workers")
+        old = [w for w in self.workers.values() if not w.retiring]
+        for worker in old:
+            worker.retiring = True
+            self.spawn(worker.index)
+        for worker in old:
+            self.kill(worker)
+
+    def stop(self):
+        log.info("stopping workers")
+        self.stopping = True
+        self.deadline = time.time() + self.pblog.shutdown_timeout + HEARTBEAT
+        for worker in self.workers.values():
+            self.kill(worker)
+
+    def run(self):
+        logging.basicConfig()
+        log.setLevel(logging.INFO)
+        self.stopping = False
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(sig, lambda sig, frame: self.signals.append(sig))
+
+        for index in range(self.size):
+            self.spawn(index)
+
+        while self.workers:
+            while self.signals:
+                sig = self.signals.pop(0)
+                if sig in (signal.SIGTERM, signal.SIGINT):
+                    if not self.stopping:
+                        self.stop()
+                elif sig == signal.SIGHUP and not self.stopping:
+                    self.restart()
+                elif sig == signal.SIGUSR1:
+                    for worker in sorted(self.workers.values(),
+                            key=lambda w: w.index):
+                        log.info(worker.report())
+
+            pipes = dict((w.pipe, w) for w in self.workers.values())
+            try:
+                ready = select.select(pipes.keys(), [], [], 1)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                ready = []
+            for pipe in ready:
+                pipes[pipe].read()
+
+            self.reap()
+            if self.stopping:
+                if time.time() > self.deadline:
+                    for worker in self.workers.values():
+                        self.kill(worker, signal.SIGKILL)
+            else:
+                self.check()
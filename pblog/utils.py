@@ -3,19 +3,332 @@
 """ Various utils, string manipulation ... """
 
 import re
+import sys
+import heapq
+import bisect
+import hashlib
+import threading
 import unicodedata
 import functools
 
-from markdown import markdown
+from collections import OrderedDict
+from markdown import Markdown
 
-def markdownize(*a, **kw):
-    """ Markdownize a string with default extensions and safe_mode On """
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError: # python2 without the "futures" backport
+    ProcessPoolExecutor = None
 
+# Bump when the markdown extensions or options change, stored
+# html is then re-rendered on next access (or with "render" command)
+RENDER_VERSION = 1
+
+MARKDOWN_EXTENSIONS = ["codehilite", "tables"]
+
+# pygments lexers and formatters kept by Renderer
+HILITE_CACHE = 64
+
+
+class LRUCache(object):
+    """ Mapping dropping least recently used items when the sum
+        of items size (in bytes) goes over max_size """
+
+    def __init__(self, max_size, group=None):
+        self.max_size = max_size
+        self.group = group
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = sys.getsizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._data.popitem(last=False)[1][1]
+                self.evictions += 1
+        if self.group is not None:
+            self.group.shrink()
+
+    def evict(self):
+        """ Drop the least recently used item """
+        with self._lock:
+            if self._data:
+                self.size -= self._data.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "items": len(self),
+                "size": self.size, "max_size": self.max_size}
+
+
+class CacheGroup(object):
+    """ LRUCache by key (eg. a blog id) sharing a memory budget, going
+        over it evicts from the largest cache """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        cache = self._caches.get(key)
+        if cache is None:
+            cache = self._caches.setdefault(key,
+                    LRUCache(self.max_size, group=self))
+        return cache
+
+    @property
+    def size(self):
+        return sum(c.size for c in self._caches.values())
+
+    def shrink(self):
+        with self._lock:
+            while self.size > self.max_size:
+                max(self._caches.values(), key=lambda c: c.size).evict()
+
+    def clear(self):
+        for cache in self._caches.values():
+            cache.clear()
+
+    @property
+    def stats(self):
+        stats = dict.fromkeys(("hits", "misses", "evictions", "items", "size"), 0)
+        for cache in self._caches.values():
+            for k in stats:
+                stats[k] += cache.stats[k]
+        stats.update(caches=len(self._caches), max_size=self.max_size)
+        return stats
+
+
+class PrefixIndex(object):
+    """ (name, count) items sorted by lower case name, looked up by
+        name prefix with bisect """
+
+    # best items of prefixes matching more items than this are memoized
+    MEMO_OVER = 100
+
+    def __init__(self, items):
+        self.items = sorted(items, key=lambda i: (i[0].lower(), i[0]))
+        self.keys = [i[0].lower() for i in self.items]
+        self._memo = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def complete(self, prefix, limit=10):
+        """ Up to limit items whose name starts with prefix (case
+            insensitive), largest counts first """
+        prefix = prefix.lower()
+        memo = self._memo.get((prefix, limit))
+        if memo is not None:
+            return memo
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + u"\uffff", lo)
+        best = heapq.nsmallest(limit, self.items[lo:hi],
+                key=lambda i: (-i[1], i[0].lower()))
+        if hi - lo > self.MEMO_OVER:
+            self._memo[(prefix, limit)] = best
+        return best
+
+
+class Renderer(object):
+    """ Markdown parser built once and reset between documents """
+
+    def __init__(self, **kw):
+        self.md = Markdown(**kw)
+        hilite = self.md.treeprocessors.get("hilite")
+        if CachedHilite is not None and \
+                getattr(hilite, "__class__", None) is HiliteTreeprocessor:
+            self.md.treeprocessors["hilite"] = CachedHilite(self.md,
+                    hilite.config)
+
+    def render(self, text):
+        try:
+            return self.md.convert(text)
+        finally:
+            self.md.reset()
+
+    def render_many(self, texts):
+        return [self.render(text) for text in texts]
+
+
+try:
+    import pygments
+    from pygments.lexers import get_lexer_by_name, guess_lexer, TextLexer
+    from pygments.formatters import HtmlFormatter
+    from markdown.extensions.codehilite import CodeHilite, HiliteTreeprocessor
+except ImportError: # no pygments (codehilite escapes the code)
+    HiliteTreeprocessor = CachedHilite = None
+else:
+    class CachedHilite(HiliteTreeprocessor):
+        """ codehilite (markdown 2.0) treeprocessor reusing the pygments
+            lexers and formatters of its renderer (HILITE_CACHE of them)
+            instead of building them for each code block """
+
+        def __init__(self, md, config):
+            HiliteTreeprocessor.__init__(self, md)
+            self.config = config
+            self.cache = LRUCache(HILITE_CACHE)
+
+        def lexer(self, lang, src):
+            lexer = self.cache.get(("lexer", lang))
+            if lexer is None:
+                try:
+                    lexer = get_lexer_by_name(lang)
+                except ValueError:
+                    lexer = False # guessed from each source
+                self.cache.set(("lexer", lang), lexer, size=1)
+            if lexer is False:
+                try:
+                    return guess_lexer(src)
+                except ValueError:
+                    return TextLexer()
+            return lexer
+
+        def formatter(self, linenos, css_class):
+            key = ("formatter", linenos, css_class)
+            formatter = self.cache.get(key)
+            if formatter is None:
+                formatter = HtmlFormatter(linenos=linenos, cssclass=css_class)
+                self.cache.set(key, formatter, size=1)
+            return formatter
+
+        def hilite(self, text):
+            code = CodeHilite(text, linenos=self.config["force_linenos"][0],
+                    css_class=self.config["css_class"][0])
+            code.src = code.src.strip("\n")
+            code._getLang()
+            return pygments.highlight(code.src, self.lexer(code.lang, code.src),
+                    self.formatter(code.linenos, code.css_class))
+
+        def run(self, root):
+            for block in root.getiterator("pre"):
+                children = block.getchildren()
+                if len(children) == 1 and children[0].tag == "code":
+                    placeholder = self.markdown.htmlStash.store(
+                            self.hilite(children[0].text), safe=True)
+                    # this paragraph is replaced by the html later
+                    block.clear()
+                    block.tag = "p"
+                    block.text = placeholder
+
+
+markdown_cache = LRUCache(8 * 1024 * 1024)
+_renderers = threading.local()
+
+def set_markdown_extensions(extensions):
+    """ Change the default markdown extensions and drop cached renders
+        (stored html needs a RENDER_VERSION bump) """
+    MARKDOWN_EXTENSIONS[:] = extensions
+    markdown_cache.clear()
+
+def _markdown_options(kw):
     # set default params for markdown
-    kw.setdefault("extensions", ["codehilite", "tables"])
+    kw.setdefault("extensions", MARKDOWN_EXTENSIONS)
     kw.setdefault("safe_mode", "escape")
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) \
+            for k, v in kw.iteritems()))
+
+def get_renderer(**kw):
+    """ Renderer of the current thread for the given markdown options """
+    options = _markdown_options(kw)
+    if not hasattr(_renderers, "pool"):
+        _renderers.pool = {}
+    if options not in _renderers.pool:
+        _renderers.pool[options] = Renderer(**kw)
+    return _renderers.pool[options]
+
+def markdownize(text, **kw):
+    """ Markdownize a string with default extensions and safe_mode On,
+        results are cached by content hash and options """
+    return markdownize_many([text], **kw)[0]
+
+def markdownize_many(texts, **kw):
+    """ Markdownize a list of strings, reusing one Renderer """
+    options = _markdown_options(kw)
+    keys = [(content_hash(text),) + options for text in texts]
+    result = [markdown_cache.get(key) for key in keys]
+    missing = [i for i, html in enumerate(result) if html is None]
+    if missing:
+        renderer = get_renderer(**kw)
+        for i, html in zip(missing,
+                renderer.render_many([texts[i] for i in missing])):
+            markdown_cache.set(keys[i], html)
+            result[i] = html
+    return result
+
+def _markdownize_chunk(texts, kw):
+    return markdownize_many(texts, **kw)
+
+def markdownize_parallel(texts, workers=None, chunk_size=50,
+        min_parallel=200, executor=None, **kw):
+    """ Markdownize a list of strings on a pool of processes,
+        results are returned in input order. Small batches (or missing
+        concurrent.futures) are rendered serially. Callers rendering
+        several batches pass their executor (see render_executor),
+        otherwise a pool is created for this call """
+    texts = list(texts)
+    if ProcessPoolExecutor is None or workers == 1 \
+            or len(texts) < min_parallel:
+        return markdownize_many(texts, **kw)
+
+    if executor is None:
+        with ProcessPoolExecutor(workers) as executor:
+            return markdownize_parallel(texts, workers, chunk_size,
+                    min_parallel, executor, **kw)
+
+    chunks = [texts[i:i+chunk_size] \
+            for i in range(0, len(texts), chunk_size)]
+    futures = [executor.submit(_markdownize_chunk, chunk, kw) \
+            for chunk in chunks]
+    result = []
+    for future in futures:
+        result.extend(future.result())
+    return result
+
+def render_executor(workers=None):
+    """ Pool of processes for markdownize_parallel calls (None if
+        rendering is serial), its workers keep their renderers and
+        markdown cache between calls, shut it down when done """
+    if ProcessPoolExecutor is None or workers == 1:
+        return None
+    return ProcessPoolExecutor(workers)
+
 
-    return markdown(*a, **kw)
+def content_hash(text):
+    """ sha1 hexdigest of a (unicode) string """
+    if isinstance(text, unicode):
+        text = text.encode("utf8")
+    return hashlib.sha1(text).hexdigest()
 
 
 def slugify(title):
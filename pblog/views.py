@@ -2,30 +2,166 @@
 
 import os
 import re
+import sys
+import time
+import gzip
+import threading
+import functools
 import datetime
+import email.utils
 
-from tornado.web import RequestHandler
-from sqlalchemy.orm import subqueryload
+from cStringIO import StringIO
+
+from collections import namedtuple
+
+from tornado.web import RequestHandler, HTTPError
+from tornado.escape import json_encode
+from sqlalchemy.orm import subqueryload, undefer
+from sqlalchemy.orm.exc import NoResultFound
 
 from pblog.core import Pblog
 from pblog.models import *
-from pblog.paginator import Paginator
-from pblog.utils import feed_content
+from pblog.models import archives, blog_tags
+from pblog.paginator import Paginator, KeysetPaginator, InvalidPage, CachedCount, KnownCount
+from pblog.utils import feed_content, content_hash, CacheGroup
+from pblog.search import get_index
+from pblog.related import related_posts
 
 __all__ = ["Root", "View", "ViewTag", "ViewPage",
-        "ViewArchive", "FeedPost", "FeedTag"]
+        "ViewArchive", "FeedPost", "FeedTag", "Search", "ViewComments"]
+
+# Caches of each blog (cache_group[blog id]), the blogs of a cache
+# group share its memory budget
+
+# sidebar data by blog version
+sidebar_cache = CacheGroup(1024 * 1024)
+
+# blog id: (conf version, PblogConf)
+conf_cache = {}
+
+# paginators totals by (blog version, listing)
+count_cache = CacheGroup(256 * 1024)
+
+# anonymous GET responses by (request key, etag), budget set
+# by the cache_size setting
+page_cache = CacheGroup(16 * 1024 * 1024)
+
+# handler of the request run by a db_pool thread
+_in_pool = threading.local()
+
+# handlers of the requests in progress, requests count (health of the process)
+active_handlers = set()
+request_stats = {"finished": 0}
+
+SidebarTag = namedtuple("SidebarTag", "name post_count")
+
+
+def threaded(method):
+    """ Decorator running a handler method (and prepare_db) on the
+        db_pool threads, with a session of its own, the response is
+        finished on the IOLoop. Without db_pool the method runs as usual """
+    @functools.wraps(method)
+    def wrapper(self, *a, **kw):
+        pool = Pblog.instance.db_pool
+        if pool is None or getattr(_in_pool, "handler", None) is self:
+            return method(self, *a, **kw)
+
+        self._auto_finish = False # as @asynchronous
+        self._finishing = False
+        def task():
+            _in_pool.handler = self
+            try:
+                self.prepare_db()
+                if not self._finishing:
+                    method(self, *a, **kw)
+                if not self._finishing:
+                    self.finish()
+            except Exception:
+                self.run_on_loop(reraise, sys.exc_info())
+            finally:
+                _in_pool.handler = None
+                Pblog.instance.Session.remove()
+        pool.apply_async(task)
+    wrapper.threaded = True
+    return wrapper
+
+def reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
 
 class BaseHandler(RequestHandler):
 
+    def prepare(self):
+        # each request works in a new session, removed by on_finish
+        Pblog.instance.Session.remove()
+        active_handlers.add(self)
+        if not self.pooled:
+            self.prepare_db()
+
+    def prepare_db(self):
+        """ Part of prepare using the database (run on the db_pool
+            by threaded methods) """
+        if self.read_replica():
+            self._orm = Pblog.instance.read_session()
+        else:
+            self._orm = Pblog.instance.session
+
+    def read_replica(self):
+        """ Can the request be served by a read replica ? """
+        return False
+
+    @property
+    def pooled(self):
+        """ Is the request method run on the db_pool ? """
+        method = getattr(self, self.request.method.lower(), None)
+        return Pblog.instance.db_pool is not None \
+                and getattr(method, "threaded", False)
+
+    def run_on_loop(self, callback, *a):
+        """ Call callback on the IOLoop serving the request (from
+            any thread), its errors are handled as request errors """
+        def run():
+            try:
+                callback(*a)
+            except Exception, e:
+                self._handle_request_exception(e)
+        self.request.connection.stream.io_loop.add_callback(run)
+
+    def on_finish(self):
+        """ Close the session (releasing its connection and objects) """
+        Pblog.instance.Session.remove()
+        if self in active_handlers:
+            active_handlers.remove(self)
+            request_stats["finished"] += 1
+
+    def finish(self, chunk=None):
+        if getattr(_in_pool, "handler", None) is self:
+            # the connection belongs to the IOLoop thread
+            self._finishing = True
+            return self.run_on_loop(BaseHandler.finish, self, chunk)
+        try:
+            return super(BaseHandler, self).finish(chunk)
+        finally:
+            if not hasattr(RequestHandler, "on_finish"):
+                # tornado < 2.2 has no on_finish hook
+                self.on_finish()
+
     def get_current_user(self):
-        return self.get_secure_cookie("user")
+        # admin cookies are only valid on their blog
+        if self.get_secure_cookie("user") == "admin:%d" % (self.blog_id,):
+            return "admin"
 
     @property
     def conf(self):
+        """ Blog configuration, unpickled again only when its
+            version changes """
         if not hasattr(self, "_conf"):
-            self._conf = Blog.query.\
-                    filter(Blog.id==self.blog.id).\
-                    one().conf
+            version = self.stamp.conf_version
+            cached = conf_cache.get(self.blog_id)
+            if cached is None or cached[0] != version:
+                cached = (version, self.orm.query(Blog.conf).\
+                        filter(Blog.id==self.blog_id).scalar())
+                conf_cache[self.blog_id] = cached
+            self._conf = cached[1]
         return self._conf
 
     @property
@@ -34,15 +170,81 @@ class BaseHandler(RequestHandler):
             self._orm = Pblog.instance.session
         return self._orm
 
+    @property
+    def blog_id(self):
+        """ Id of the blog served on the request host """
+        if not hasattr(self, "_blog_id"):
+            self._blog_id = Pblog.instance.host_blog_id(self.request.host)
+        return self._blog_id
+
     @property
     def blog(self):
         if not hasattr(self, "_blog"):
-            self._blog = Pblog.instance.blog
+            self._blog = self.orm.query(Blog).get(self.blog_id)
         return self._blog
 
+    @property
+    def stamp(self):
+        """ (version, conf_version, modified, tag_version) of the
+            blog, read once by request """
+        if not hasattr(self, "_stamp"):
+            self._stamp = self.orm.query(Blog.version,
+                    Blog.conf_version, Blog.modified, Blog.tag_version).\
+                    filter(Blog.id==self.blog_id).one()
+        return self._stamp
+
+    @property
+    def version(self):
+        """ Content version of the blog """
+        return self.stamp.version
+
+    def touch(self, tags=False):
+        """ Bump the blog content version (and the tags version if
+            tags changed) on next commit, data cached for the previous
+            version is no longer used """
+        self._touched = True
+        if tags:
+            self._tags_touched = True
+
+    @property
+    def search_index(self):
+        return get_index(Pblog.instance.engine)
+
+    def cached_count(self, *key):
+        """ Count strategy keeping the total until the blog changes """
+        return CachedCount(count_cache[self.blog_id],
+                (self.version,) + key)
+
+    def paginate(self, query, per_page, keys=None, count=None):
+        """ Page of query for the request, by cursor on keys (descending
+            order columns) if set in conf, by page number otherwise
+            (total computed by the count strategy) """
+        try:
+            if keys and self.conf.pagination == "keyset":
+                return KeysetPaginator(query, per_page, keys).\
+                        page(self.get_argument("c", None))
+            return Paginator(query, per_page, count=count).\
+                    page(self.get_argument("p", 1))
+        except InvalidPage:
+            raise HTTPError(404)
+
     def commit(self):
         try:
+            if getattr(self, "_touched", False):
+                values = {Blog.version: Blog.version + 1,
+                        Blog.modified: datetime.datetime.utcnow()}
+                if getattr(self, "_tags_touched", False):
+                    values[Blog.tag_version] = Blog.tag_version + 1
+                self.orm.query(Blog).\
+                        filter(Blog.id==self.blog_id).\
+                        update(values, synchronize_session=False)
+                self._touched = self._tags_touched = False
             self.orm.commit()
+            if hasattr(self, "_stamp"):
+                del self._stamp
+            if Pblog.instance.db_replicas:
+                # read your writes: next requests use the primary
+                self.set_cookie("pblog_written", "%d" % (time.time(),))
         except:
             self.orm.rollback()
             raise HTTPError(500)
@@ -50,15 +252,98 @@ class BaseHandler(RequestHandler):
 
 class ViewHandler(BaseHandler):
 
+    # anonymous GET responses are cached by blog versions
+    cache_response = True
+
+    def prepare_db(self):
+        super(ViewHandler, self).prepare_db()
+        self._cache_key = None
+        if not self.cacheable():
+            return
+
+        key = self.cache_key()
+        etag = '"%s"' % (content_hash(repr((key, tuple(self.stamp)))),)
+        self.set_header("Etag", etag)
+        if self.stamp.modified:
+            self.set_header("Last-Modified", self.stamp.modified)
+
+        if self.not_modified(etag, self.stamp.modified):
+            self.set_status(304)
+            return self.finish()
+
+        entry = page_cache[self.blog_id].get((key, etag))
+        if entry is not None:
+            return self.send_cached(entry)
+        self._cache_key = (key, etag)
+
+    def read_replica(self):
+        if self.request.method != "GET" or not Pblog.instance.db_replicas:
+            return False
+        try:
+            written = float(self.get_cookie("pblog_written"))
+        except (TypeError, ValueError):
+            return True
+        return time.time() - written > Pblog.instance.replica_lag
+
+    def cacheable(self):
+        return self.request.method == "GET" \
+                and self.cache_response \
+                and not self.current_user
+
+    def cache_key(self):
+        """ Identify the response of a GET request """
+        args = sorted((k, tuple(v)) for k, v \
+                in self.request.arguments.iteritems())
+        return (self.request.host, self.request.path,
+                tuple(args), self.conf.theme)
+
+    def not_modified(self, etag, modified):
+        """ Check conditional request headers """
+        if "If-None-Match" in self.request.headers:
+            etags = [e.strip() for e in \
+                    self.request.headers["If-None-Match"].split(",")]
+            return etag in etags or "*" in etags
+        since = self.request.headers.get("If-Modified-Since")
+        if since and modified:
+            since = email.utils.parsedate(since)
+            return bool(since) and \
+                    datetime.datetime(*since[:6]) >= modified.replace(microsecond=0)
+        return False
+
+    def cache_entry(self, chunk):
+        """ (cached entry, size) for a rendered response """
+        return chunk, len(chunk)
+
+    def send_cached(self, entry):
+        return self.finish(entry)
+
+    def finish(self, chunk=None):
+        if getattr(self, "_cache_key", None) and chunk is not None \
+                and self.get_status() == 200:
+            page_cache[self.blog_id].set(self._cache_key,
+                    *self.cache_entry(chunk))
+        return super(ViewHandler, self).finish(chunk)
+
+    @property
+    def sidebar(self):
+        """ Tags cloud and archives, computed once by blog version """
+        cache = sidebar_cache[self.blog_id]
+        sidebar = cache.get(self.version)
+        if sidebar is None:
+            sidebar = {
+                    "all_tags": [SidebarTag(*t) \
+                            for t in blog_tags(self.orm, self.blog_id)],
+                    "archives": archives(self.orm, self.blog_id),
+                    }
+            cache.set(self.version, sidebar, size=100 * \
+                    (len(sidebar["all_tags"]) + len(sidebar["archives"])))
+        return sidebar
+
     def render(self, *a, **kw):
-        archives = [datetime.date(e.post_date.year, e.post_date.month, 1) for e in Post.query.all()]
-        archives = [(v, archives.count(v)) for v in list(set(archives))]
-        archives.sort(reverse=True)
+        kw.update(self.sidebar)
         kw.update({
             "conf": self.conf,
             "theme_url": self.conf.media_url+self.conf.theme,
-            "all_tags": Tag.query.all(),
-            "archives": archives,
             })
         for k in ("EMAIL_DISABLED", "EMAIL_OPTIONAL", "EMAIL_REQUIRED"):
             kw.update({k: getattr(PblogConf, k)})
@@ -71,12 +356,13 @@ class ViewHandler(BaseHandler):
 
 
 class Root(ViewHandler):
+    @threaded
     def get(self):
-        page = int(self.get_argument("p", 1))
-        posts = Paginator(Post.query.\
+        posts = self.paginate(Post.query.\
                 filter(Post.blog==self.blog).\
                 options(subqueryload(Post.tags)),
-                self.conf.max_post).page(page)
+                self.conf.max_post, keys=(Post.post_date, Post.id),
+                count=self.cached_count("root"))
         return self.render("list.html", posts=posts)
 
 class View(ViewHandler):
@@ -85,23 +371,35 @@ class View(ViewHandler):
             return Post.query.\
                     filter(Post.blog==self.blog).\
                     filter(Post.slug==slug).\
-                    options(subqueryload(Post.tags)).\
-                    options(subqueryload(Post.comments)).one()
+                    options(undefer(Post.content), undefer(Post.html)).\
+                    options(subqueryload(Post.tags)).one()
         except NoResultFound:
             raise HTTPError(404)
 
+    def comments(self, post):
+        """ Page of the post comments, newer first """
+        return self.paginate(Comment.query.\
+                filter(Comment.pid==post.id).\
+                order_by(Comment.post_date.desc(), Comment.id.desc()),
+                self.conf.max_comment, keys=(Comment.post_date, Comment.id),
+                count=KnownCount(post.comment_count))
+
+    @threaded
     def get(self, slug):
         post = self.get_post(slug)
-        new_comment = Comment()
-        return self.render("post.html",
-                post=post, new_comment=new_comment)
+        new_comment = Comment(bid=self.blog_id)
+        return self.render("post.html", post=post,
+                comments=self.comments(post),
+                related=related_posts(self.orm, post), new_comment=new_comment)
 
+    @threaded
     def post(self, slug):
         """ Post a comment on the given post """
 
         post = self.get_post(slug)
 
-        kwargs = {"post": post, "ip": self.request.remote_ip }
+        kwargs = {"post": post, "bid": self.blog_id,
+                "ip": self.request.remote_ip }
 
         for k in ("name", "email", "content"):
             kwargs.update({k: self.get_argument(k, "")})
@@ -112,35 +410,71 @@ class View(ViewHandler):
             if not getattr(new_comment, k):
                 new_comment.errors[k] = self.locale.translate("Cannot be empty")
 
-        if not new_comment.email and self.conf.email == conf.EMAIL_REQUIRED:
+        if not new_comment.email and self.conf.email == PblogConf.EMAIL_REQUIRED:
             new_comment.errors["email"] = self.locale.translate("Cannot be empty")
         elif self.conf.email \
-                and self.conf.email != conf.EMAIL_DISABLED \
+                and self.conf.email != PblogConf.EMAIL_DISABLED \
                 and not re.match(".+@.+", new_comment.email):
             new_comment.errors["email"] = self.locale.translate("Not a valid email address")
 
         if not new_comment.errors:
-            self.session.add(new_comment)
+            new_comment.update_html()
+            self.orm.add(new_comment)
+            post.comment_count = Post.comment_count + 1
+            self.touch()
             self.commit()
-            new_comment = Comment()
+            new_comment = Comment(bid=self.blog_id)
 
-        return self.render("post.html",
-                post=post, new_comment=new_comment)
+        return self.render("post.html", post=post,
+                comments=self.comments(post),
+                related=related_posts(self.orm, post), new_comment=new_comment)
+
+class ViewComments(View):
+    """ Further pages of the comments of a post ("load more"), as
+        JSON: the html of the comments and the next page argument """
+    SUPPORTED_METHODS = ("GET",)
+
+    def get_post(self, slug):
+        try:
+            return Post.query.\
+                    filter(Post.blog==self.blog).\
+                    filter(Post.slug==slug).one()
+        except NoResultFound:
+            raise HTTPError(404)
+
+    def send_cached(self, entry):
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        return self.finish(entry)
+
+    @threaded
+    def get(self, slug):
+        post = self.get_post(slug)
+        comments = self.comments(post)
+        more = None
+        if comments.has_next():
+            more = "%s=%s" % (comments.paginator.param,
+                    comments.next_page_number())
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        return self.finish(json_encode({
+            "html": self.render_string("comments.html", post=post,
+                comments=comments),
+            "next": more}))
 
 
 class ViewTag(ViewHandler):
+    @threaded
     def get(self, tag):
-        page = int(self.get_argument("p", 1))
-        posts = Paginator(Post.query.\
+        posts = self.paginate(Post.query.\
                 filter(Post.blog==self.blog).\
                 filter(Post.tags.any(Tag.name==unicode(tag))).\
                 options(subqueryload(Post.tags)),
-                    self.conf.max_post).page(page)
+                self.conf.max_post, keys=(Post.post_date, Post.id),
+                count=self.cached_count("tag", tag))
         return self.render("list.html", posts=posts)
 
 class ViewArchive(ViewHandler):
+    @threaded
     def get(self, year, month):
-        page = int(self.get_argument("p", 1))
         year = int(year)
         month = int(month)
 
@@ -153,34 +487,81 @@ class ViewArchive(ViewHandler):
 
         from_date = datetime.date(year, month, 1)
         to_date = datetime.date(next_year, next_month, 1)
-        posts = Paginator(Post.query.\
+        posts = self.paginate(Post.query.\
                 filter(Post.blog==self.blog).\
                 filter(Post.post_date > from_date).\
                 filter(Post.post_date < to_date).\
                 options(subqueryload(Post.tags)),
-                self.conf.max_post).page(page)
+                self.conf.max_post,
+                count=self.cached_count("archive", year, month))
         return self.render("list.html", posts=posts)
 
-class FeedPost(ViewHandler):
+class Search(ViewHandler):
+    @threaded
+    def get(self):
+        q = self.get_argument("q", u"").strip()
+        posts = None
+        if q:
+            posts = self.paginate(self.search_index.results(self.orm,
+                self.blog_id, q), self.conf.max_post,
+                count=self.cached_count("search", q))
+        return self.render("search.html", q=q, posts=posts)
+
+class FeedHandler(ViewHandler):
+    """ Feeds are the same for every client, they are cached
+        (plain and gzipped) by blog version and url """
+
+    def cacheable(self):
+        return self.request.method == "GET"
+
+    def cache_key(self):
+        return (self.request.protocol, self.request.host,
+                self.request.path, self.conf.theme)
+
+    def cache_entry(self, chunk):
+        buf = StringIO()
+        f = gzip.GzipFile(mode="wb", fileobj=buf)
+        f.write(chunk)
+        f.close()
+        gzipped = buf.getvalue()
+        return (chunk, gzipped), len(chunk) + len(gzipped)
+
+    def send_cached(self, entry):
+        body, gzipped = entry
+        self.set_header("Content-Type", "application/xml; charset=utf-8")
+        if not self.settings.get("gzip"):
+            self.set_header("Vary", "Accept-Encoding")
+            if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+                self.set_header("Content-Encoding", "gzip")
+                body = gzipped
+        return self.finish(body)
+
+class FeedPost(FeedHandler):
+    @threaded
     @feed_content
     def get(self):
         posts = Post.query.\
                 filter(Post.blog==self.blog).\
                 options(subqueryload(Post.tags)).\
+                options(undefer(Post.content), undefer(Post.html)).\
                 limit(self.conf.max_feed)
         return {"posts": posts}
 
-class FeedTag(ViewHandler):
+class FeedTag(FeedHandler):
+    @threaded
     @feed_content
     def get(self, tag_name):
         posts = Post.query.\
-                filter(Pblog.blog==self.blog).\
+                filter(Post.blog==self.blog).\
                 filter(Post.tags.any(Tag.name==unicode(tag_name))).\
+                options(subqueryload(Post.tags)).\
+                options(undefer(Post.content), undefer(Post.html)).\
                 limit(self.conf.max_feed)
         return {"posts": posts}
 
 
 class ViewPage(ViewHandler):
+    @threaded
     def get(self, slug):
         try:
             page = Page.query.\
@@ -0,0 +1,41 @@
+# -*- coding: utf8 -*-
+
+# Per document markdown cost: markdown() building a parser for each
+# call versus the reusable pblog Renderer.
+# usage: python bench_render.py [documents]
+
+import sys
+import time
+
+from markdown import markdown
+
+from pblog.utils import Renderer, MARKDOWN_EXTENSIONS
+
+DOCUMENT = u"""Title %d
+========
+
+Some *text* with a [link](http://example.com/%d) and `code`.
+
+    :::python
+    def foo(bar):
+        return bar * %d
+
+| name | value |
+|------|-------|
+| a    | %d    |
+"""
+
+def bench(name, render, texts):
+    start = time.time()
+    for text in texts:
+        render(text)
+    elapsed = time.time() - start
+    print "%-10s %8.3f ms/doc" % (name, elapsed * 1000 / len(texts))
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    texts = [DOCUMENT % ((i,) * 4) for i in range(count)]
+    bench("markdown", lambda t: markdown(t,
+        extensions=MARKDOWN_EXTENSIONS, safe_mode="escape"), texts)
+    renderer = Renderer(extensions=MARKDOWN_EXTENSIONS, safe_mode="escape")
+    bench("renderer", renderer.render, texts)